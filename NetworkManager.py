@@ -4,14 +4,19 @@
 # (C)2011-2021 Dennis Kaarsemaker
 # License: zlib
 
-import copy
+import array
+import collections
 import dbus
 import dbus.service
+import json
+import math
 import os
 import six
 import socket
 import struct
 import sys
+import tempfile
+import threading
 import time
 import warnings
 import weakref
@@ -22,20 +27,103 @@ class ObjectVanished(Exception):
         self.obj = obj
         super(ObjectVanished, self).__init__(obj.object_path)
 
+class SignalHandler(object):
+    """Returned when connecting to a signal. Call remove() to stop receiving
+       the signal."""
+    def __init__(self, keys, obj, func, args, kwargs):
+        coalesce = kwargs.pop('coalesce', None)
+        if coalesce:
+            func = SignalCoalescer(func, coalesce)
+        self.keys = keys
+        self.obj = obj
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.path = None
+
+    def remove(self):
+        SignalDispatcher.unregister(self)
+        if isinstance(self.func, SignalCoalescer):
+            self.func.cancel()
+
+class SignalCoalescer(object):
+    """Wraps a signal handler so it gets at most one signal per object every
+       window seconds. For PropertiesChanged the changed properties are
+       merged, with the latest value of each property winning. For other
+       signals only the last one is delivered."""
+    def __init__(self, func, window):
+        if not dbus.get_default_main_loop():
+            raise RuntimeError("Coalescing signals requires a mainloop")
+        from gi.repository import GLib
+        self.GLib = GLib
+        self.func = func
+        self.window = window
+        # (object path, interface, signal) -> (object, args, kwargs)
+        self.pending = collections.OrderedDict()
+        self.source = None
+
+    def __call__(self, obj, *args, **kwargs):
+        key = (obj.object_path, kwargs['interface'], kwargs['signal'])
+        standard = kwargs['interface'] == 'org.freedesktop.DBus.Properties' and len(args) == 3
+        if standard:
+            # The standard signal is sent for all interfaces of the object,
+            # changes of different interfaces must not be merged.
+            key += (args[0],)
+        if key in self.pending and kwargs['signal'] == 'PropertiesChanged':
+            old_args, old_kwargs = self.pending[key][1:]
+            if standard:
+                changed = self.merge(dict((name, value) for name, value in old_args[1].items() if name not in args[2]), args[1])
+                invalidated = [x for x in old_args[2] if x not in args[1]] + [x for x in args[2] if x not in old_args[2]]
+                args = (args[0], changed, invalidated)
+            elif 'properties' in kwargs:
+                kwargs['properties'] = self.merge(old_kwargs['properties'], kwargs['properties'])
+            elif args and isinstance(args[0], dict):
+                # Older NetworkManager versions don't supply attribute names
+                args = (self.merge(old_args[0], args[0]),) + args[1:]
+        self.pending[key] = (obj, args, kwargs)
+        if self.source is None:
+            self.source = self.GLib.timeout_add(int(self.window * 1000), self.flush)
+
+    @staticmethod
+    def merge(old, new):
+        ret = dict(old)
+        ret.update(new)
+        return ret
+
+    def flush(self):
+        self.source = None
+        pending, self.pending = self.pending, collections.OrderedDict()
+        for obj, args, kwargs in pending.values():
+            self.func(obj, *args, **kwargs)
+        return False
+
+    def cancel(self):
+        if self.source is not None:
+            self.GLib.source_remove(self.source)
+            self.source = None
+        self.pending.clear()
+
 class SignalDispatcher(object):
     def __init__(self):
         self.handlers = {}
         self.args = {}
-        self.interfaces = set()
-        self.setup = False
-
-    def setup_signals(self):
-        if not self.setup:
-            bus = dbus.SystemBus()
-            for interface in self.interfaces:
-                bus.add_signal_receiver(self.handle_signal, dbus_interface=interface, interface_keyword='interface', member_keyword='signal', path_keyword='path')
-            self.setup = True
-        self.listen_for_restarts()
+        # (signal, class name) -> (args, converters for those args)
+        self.converters = {}
+        # (callback, interface, signal, path) -> [match rule, reference count]
+        self.matches = {}
+        # Object path -> weak references to objects that cache their properties
+        self.caches = {}
+        self.caches_setup = False
+        # Information about the last restart of NetworkManager
+        self.state = 'ready'
+        self.restart_info = {}
+        self.restart_handlers = []
+        # Object path -> interface name of devices with handlers or caches
+        self.device_names = {}
+        # Incremented on every restart, so late replies for an earlier
+        # restart are ignored
+        self.generation = 0
+        self.startup_watched = False
 
     def listen_for_restarts(self):
         # If we have a mainloop, listen for disconnections
@@ -43,66 +131,1200 @@ class SignalDispatcher(object):
            dbus.SystemBus().add_signal_receiver(self.handle_restart, 'NameOwnerChanged', 'org.freedesktop.DBus')
            NMDbusInterface.last_disconnect = 1
 
+    def add_match(self, callback, interface, signal, path, arg0=None):
+        # Only ask the bus for the signals we are interested in, so we're not
+        # woken up for every signal NetworkManager sends.
+        key = (callback, interface, signal, path, arg0)
+        if key in self.matches:
+            self.matches[key][1] += 1
+            return
+        kwargs = {'arg0': arg0} if arg0 is not None else {}
+        match = dbus.SystemBus().add_signal_receiver(callback, signal, interface, NMDbusInterfaceType.dbus_service, path,
+            interface_keyword='interface', member_keyword='signal', path_keyword='path', byte_arrays=True, **kwargs)
+        self.matches[key] = [match, 1]
+
+    def remove_match(self, callback, interface, signal, path, arg0=None):
+        key = (callback, interface, signal, path, arg0)
+        if key not in self.matches:
+            return
+        self.matches[key][1] -= 1
+        if not self.matches[key][1]:
+            self.matches.pop(key)[0].remove()
+
     def add_signal_receiver(self, interface, signal, obj, func, args, kwargs):
-        self.setup_signals()
-        key = (interface, signal)
-        if key not in self.handlers:
-            self.handlers[key] = []
-        self.handlers[key].append((obj, func, args, kwargs))
+        handler = SignalHandler([(interface, signal)], obj, func, args, kwargs)
+        self.register(handler)
+        return handler
+
+    def register(self, handler):
+        # Handlers are indexed by object path, so dispatching a signal doesn't
+        # need to compare objects. Handlers for all objects of a class are
+        # stored under None.
+        self.listen_for_restarts()
+        handler.path = None if isinstance(handler.obj, type) else handler.obj.object_path
+        if handler.path is not None:
+            self.watch_removals()
+            self.remember_device(handler.obj)
+        callback = self.handle_wildcard_signal if handler.path is None else self.handle_signal
+        for key in handler.keys:
+            self.handlers.setdefault(key, {}).setdefault(handler.path, []).append(handler)
+            self.add_match(callback, key[0], key[1], handler.path)
+
+    def remember_device(self, obj):
+        # Devices get a new object path when NetworkManager restarts, so we
+        # need their interface name to find them again.
+        if not isinstance(obj, Device) or obj.object_path in self.device_names or self.state != 'ready':
+            return
+        path = obj.object_path
+        name = (obj._cache or {}).get('org.freedesktop.NetworkManager.Device', {}).get('Interface', None)
+        if name is not None:
+            self.device_names[path] = six.text_type(name)
+            return
+        # Without a mainloop, restarts aren't noticed anyway. Otherwise ask
+        # for the name without blocking whoever connects the handler.
+        if not dbus.get_default_main_loop():
+            return
+        def remember(name, generation=self.generation):
+            # Unless the device went away or NetworkManager restarted meanwhile
+            if generation == self.generation and any(path in handlers for handlers in self.handlers.values()):
+                self.device_names.setdefault(path, six.text_type(name))
+        proxy = dbus.SystemBus().get_object(NMDbusInterfaceType.dbus_service, path)
+        proxy.Get('org.freedesktop.NetworkManager.Device', 'Interface', dbus_interface='org.freedesktop.DBus.Properties',
+                  reply_handler=remember, error_handler=lambda error: None)
+
+    def unregister(self, handler):
+        callback = self.handle_wildcard_signal if handler.path is None else self.handle_signal
+        for key in handler.keys:
+            handlers = self.handlers.get(key, {}).get(handler.path, [])
+            if handler not in handlers:
+                continue
+            handlers.remove(handler)
+            if not handlers:
+                del self.handlers[key][handler.path]
+            self.remove_match(callback, key[0], key[1], handler.path)
 
     def handle_signal(self, *args, **kwargs):
+        self.dispatch(args, kwargs, kwargs['path'])
+
+    def handle_wildcard_signal(self, *args, **kwargs):
+        self.dispatch(args, kwargs, None)
+
+    def dispatch(self, args, kwargs, lookup):
         key = (kwargs['interface'], kwargs['signal'])
-        skwargs = {}
+        path = kwargs['path']
+        handlers = list(self.handlers.get(key, {}).get(lookup, []))
+        # Only create the sender and convert the arguments if someone is
+        # listening, and do it only once for all handlers.
+        sender = None
+        converted = {}
+        for handler in handlers:
+            match, receiver, rargs, rkwargs = handler.obj, handler.func, handler.args, handler.kwargs
+            try:
+                if not isinstance(match, type):
+                    obj = match
+                else:
+                    if sender is None:
+                        sender = fixups.base_to_python(path)
+                    if not isinstance(sender, match):
+                        continue
+                    obj = sender
+                klass = type(obj).__name__
+                if klass not in converted:
+                    converted[klass] = self.convert_args(key, klass, args)
+            except dbus.exceptions.DBusException:
+                # This happens if the sender went away. Tough luck, no signal for you.
+                return
+            sargs, skwargs = converted[klass]
+            rkwargs = dict(rkwargs)
+            rkwargs['interface'] = kwargs['interface']
+            rkwargs['signal'] = kwargs['signal']
+            rkwargs.update(skwargs)
+            receiver(obj, *(sargs + rargs), **rkwargs)
+
+    def convert_args(self, key, klass, args):
+        spec = self.args.get(key, [])
+        if (key, klass) not in self.converters or self.converters[(key, klass)][0] is not spec:
+            self.converters[(key, klass)] = (spec, [(name, fixups.converter('to_python', klass, key[1], name, signature)) for name, signature in spec])
         sargs = []
-        if key not in self.handlers:
+        skwargs = {}
+        for arg, (name, convert) in zip(args, self.converters[(key, klass)][1]):
+            if name:
+                skwargs[name] = convert(arg)
+            else:
+                # Older NetworkManager versions don't supply attribute names. Hope for the best.
+                sargs.append(convert(arg))
+        return sargs, skwargs
+
+    def watch_removals(self):
+        # Caches and handlers of objects that disappear must be dropped, or
+        # they and their match rules would stay around forever.
+        if not self.caches_setup:
+            dbus.SystemBus().add_signal_receiver(self.handle_interfaces_removed, 'InterfacesRemoved', 'org.freedesktop.DBus.ObjectManager', NMDbusInterfaceType.dbus_service)
+            self.caches_setup = True
+
+    def watch_properties(self, obj):
+        self.watch_removals()
+        self.listen_for_restarts()
+        self.unwatch_properties(obj)
+        path = obj.object_path
+        self.caches.setdefault(path, []).append(weakref.ref(obj, lambda ref: self.forget_cache(path, ref)))
+        self.add_match(self.handle_properties_changed, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', path)
+
+    def unwatch_properties(self, obj):
+        for ref in list(self.caches.get(obj.object_path, [])):
+            if ref() is obj:
+                self.forget_cache(obj.object_path, ref)
+
+    def forget_cache(self, path, ref):
+        if ref in self.caches.get(path, []):
+            self.caches[path].remove(ref)
+            if not self.caches[path]:
+                del self.caches[path]
+            self.remove_match(self.handle_properties_changed, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', path)
+
+    def handle_properties_changed(self, interface_name, changed, invalidated, **kwargs):
+        for ref in self.caches.get(kwargs['path'], []):
+            obj = ref()
+            if obj is None or obj._cache is None or interface_name not in obj._cache:
+                continue
+            obj._cache[interface_name].update(changed)
+            for name in invalidated:
+                obj._cache[interface_name].pop(name, None)
+
+    def handle_interfaces_removed(self, path, interfaces):
+        for ref in list(self.caches.get(path, [])):
+            obj = ref()
+            if obj is not None:
+                obj._cache = None
+            self.forget_cache(path, ref)
+        for handlers in list(self.handlers.values()):
+            for handler in list(handlers.get(path, [])):
+                handler.remove()
+        self.device_names.pop(path, None)
+        NMDbusInterface.specializations.pop(path, None)
+
+    def add_restart_handler(self, func):
+        """Call func(state, info) when NetworkManager stops ('stopped'), when a
+           new instance appears ('started') and when it has finished starting
+           up and all signal handlers are connected again ('ready'). info is
+           a dict with timestamps and statistics of the restart."""
+        self.restart_handlers.append(func)
+
+    def remove_restart_handler(self, func):
+        if func in self.restart_handlers:
+            self.restart_handlers.remove(func)
+
+    def restart_event(self, state, **info):
+        self.state = state
+        self.restart_info[state] = time.time()
+        self.restart_info.update(info)
+        for func in list(self.restart_handlers):
+            func(state, dict(self.restart_info))
+
+    # Recovering from a NetworkManager restart is done asynchronously, so we
+    # never block the mainloop. Once the new instance is there, we wait for
+    # it to finish starting up, fetch all its objects in one go and then
+    # reconnect all signal handlers.
+    def handle_restart(self, name, old, new):
+        if str(name) != 'org.freedesktop.NetworkManager':
             return
+        self.generation += 1
+        if str(new) == "":
+            self.restart_info = {}
+            self.restart_event('stopped')
+            return
+        if 'stopped' not in self.restart_info:
+            self.restart_info = {}
+        NMDbusInterface.last_disconnect = time.time()
+        # Object paths may point to different objects after a restart
+        NMDbusInterface.instances.clear()
+        NMDbusInterface.specializations.clear()
+        IntrospectionCache.invalidate()
+        # Anything we cached may be outdated, refetch it when it's needed
+        for path, refs in self.caches.items():
+            for ref in refs:
+                obj = ref()
+                if obj is not None and obj._cache is not None:
+                    name = obj._cache.get('org.freedesktop.NetworkManager.Device', {}).get('Interface', None)
+                    if name is not None:
+                        self.device_names[path] = name
+                    obj._cache.clear()
+        if not self.startup_watched:
+            self.add_match(self.handle_startup, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', '/org/freedesktop/NetworkManager')
+            self.startup_watched = True
+        self.restart_event('started')
+        proxy = dbus.SystemBus().get_object(NMDbusInterfaceType.dbus_service, '/org/freedesktop/NetworkManager')
+        # Older NetworkManager versions don't have the Startup property, we
+        # treat them as started immediately.
+        proxy.Get('org.freedesktop.NetworkManager', 'Startup', dbus_interface='org.freedesktop.DBus.Properties',
+                  reply_handler=lambda startup, generation=self.generation: startup or self.resolve(generation),
+                  error_handler=lambda error, generation=self.generation: self.resolve(generation))
+
+    def handle_startup(self, interface_name, changed, invalidated, **kwargs):
+        if not changed.get('Startup', True):
+            self.resolve(self.generation)
+
+    def resolve(self, generation):
+        if generation != self.generation or self.state != 'started':
+            return
+        self.state = 'resolving'
+        if self.startup_watched:
+            self.remove_match(self.handle_startup, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', '/org/freedesktop/NetworkManager')
+            self.startup_watched = False
+        proxy = dbus.SystemBus().get_object(NMDbusInterfaceType.dbus_service, '/org/freedesktop')
+        proxy.GetManagedObjects(dbus_interface='org.freedesktop.DBus.ObjectManager', byte_arrays=True,
+                                reply_handler=lambda objects: self.reconnect(objects, generation),
+                                error_handler=lambda error: self.reconnect(None, generation))
+
+    def reconnect(self, objects, generation):
+        if generation != self.generation:
+            # NetworkManager restarted again while we were waiting
+            return
+        # Devices get new object paths, but keep their interface name. A path
+        # may even be reused for another device.
+        paths = {}
+        for path, interfaces in (objects or {}).items():
+            if 'org.freedesktop.NetworkManager.Device' in interfaces:
+                paths[interfaces['org.freedesktop.NetworkManager.Device']['Interface']] = six.text_type(path)
+        moved = {}
+        gone = set()
+        for path, name in self.device_names.items():
+            if name not in paths:
+                gone.add(path)
+            elif path != paths[name]:
+                moved[path] = paths[name]
+        if objects is not None:
+            self.device_names = dict([(path, name) for name, path in paths.items()])
+        # Objects can be both cached and have handlers, only move them once
+        relocated = {}
+
+        def relocate(obj):
+            if id(obj) not in relocated:
+                relocated[id(obj)] = (obj, move(obj))
+            return relocated[id(obj)][1]
+
+        def move(obj):
+            if obj.is_transient:
+                return False
+            if objects is None:
+                return True
+            if obj.object_path in moved:
+                watched = obj._cache is not None
+                if watched:
+                    self.unwatch_properties(obj)
+                obj.object_path = moved[obj.object_path]
+                obj._proxy = None
+                if watched:
+                    self.watch_properties(obj)
+                return True
+            return obj.object_path in objects and obj.object_path not in gone
+
+        for path, refs in list(self.caches.items()):
+            for ref in list(refs):
+                obj = ref()
+                if obj is not None and not relocate(obj):
+                    obj._cache = None
+                    self.forget_cache(path, ref)
+
+        handlers = []
+        for key in self.handlers:
+            for path in self.handlers[key]:
+                handlers += [handler for handler in self.handlers[key][path] if handler not in handlers]
+        resolved = dropped = 0
+        for handler in handlers:
+            self.unregister(handler)
+            if handler.path is not None and not relocate(handler.obj):
+                dropped += 1
+                continue
+            self.register(handler)
+            resolved += 1
+        self.restart_event('ready', duration=time.time() - self.restart_info['started'], resolved=resolved, dropped=dropped)
+
+SignalDispatcher = SignalDispatcher()
+
+# Method calls that don't block. Replies are received on a private connection
+# whose mainloop runs in a separate thread, so this works without integrating
+# a GLib mainloop in the application. This uses the default GLib main context,
+# so it can't be combined with a GLib mainloop in the main thread.
+class AsyncBus(object):
+    def __init__(self):
+        self.bus = None
+        self.lock = threading.Lock()
+
+    def get_bus(self):
+        # Our thread runs the default GLib main context, which a mainloop of
+        # the application would use as well.
+        if dbus.get_default_main_loop():
+            raise RuntimeError("The asyncio methods can't be used together with a dbus mainloop")
+        with self.lock:
+            if self.bus is None:
+                from gi.repository import GLib
+                from dbus.mainloop.glib import DBusGMainLoop, threads_init
+                threads_init()
+                self.bus = dbus.SystemBus(private=True, mainloop=DBusGMainLoop())
+                thread = threading.Thread(target=GLib.MainLoop().run, name='NetworkManager-AsyncBus')
+                thread.daemon = True
+                thread.start()
+        return self.bus
+
+    def call_async(self, obj, interface, method, args, signature, reply_handler, error_handler, bus=None):
+        """Call a method of obj, and call reply_handler(*ret) or
+           error_handler(exception) from the mainloop thread when it's done.
+           Uses our own connection, unless another bus is given."""
+        if obj.is_transient and obj._proxy is not None and obj._proxy.created < obj.last_disconnect:
+            raise ObjectVanished(obj)
+        proxy = (bus or self.get_bus()).get_object(obj.dbus_service, obj.object_path, introspect=False)
+        proxy.get_dbus_method(method, interface)(*args, signature=signature, byte_arrays=True,
+                                                 reply_handler=reply_handler, error_handler=error_handler)
+
+    def call(self, obj, interface, method, args, signature, convert):
+        """Call a method of obj and return an asyncio future for the result
+           of convert(return values)"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
         try:
-            sender = fixups.base_to_python(kwargs['path'])
-            for arg, (name, signature) in zip(args, self.args[key]):
-                if name:
-                    skwargs[name] = fixups.to_python(type(sender).__name__, kwargs['signal'], name, arg, signature)
-                else:
-                    # Older NetworkManager versions don't supply attribute names. Hope for the best.
-                    sargs.append(fixups.to_python(type(sender).__name__, kwargs['signal'], None, arg, signature))
-        except dbus.exceptions.DBusException:
-            # This happens if the sender went away. Tough luck, no signal for you.
+            self.call_async(obj, interface, method, args, signature,
+                lambda *ret: loop.call_soon_threadsafe(self.resolve, future, convert, ret),
+                lambda error: loop.call_soon_threadsafe(self.reject, future, obj, error))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def done(self, value):
+        import asyncio
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(value)
+        return future
+
+    def resolve(self, future, convert, ret):
+        if future.cancelled():
             return
-        to_delete = []
-        for pos, (match, receiver, rargs, rkwargs) in enumerate(self.handlers[key]):
+        try:
+            future.set_result(convert(ret))
+        except Exception as e:
+            future.set_exception(e)
+
+    def reject(self, future, obj, error):
+        if future.cancelled():
+            return
+        future.set_exception(self.exception(obj, error))
+
+    def exception(self, obj, error):
+        if isinstance(error, dbus.exceptions.DBusException) and error.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
+            return ObjectVanished(obj)
+        return error
+AsyncBus = AsyncBus()
+
+class Batch(object):
+    """Within a batch, the first property read of an object fetches all
+       properties of that interface with GetAll, and later reads are served
+       from that copy. So reading many properties takes only a few calls, and
+       gives values from the same point in time. Batches are per thread."""
+    local = threading.local()
+
+    def __init__(self, obj=None):
+        self.obj = obj
+        self.values = {}
+
+    def __enter__(self):
+        self.local.__dict__.setdefault('batches', []).append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.local.batches.remove(self)
+        self.values.clear()
+
+    @classmethod
+    def cache(klass, obj):
+        """The innermost active batch's property data for obj, or None"""
+        for batch in reversed(getattr(klass.local, 'batches', ())):
+            if batch.obj is None or batch.obj.object_path == obj.object_path:
+                return batch.values.setdefault(obj.object_path, {})
+
+    @classmethod
+    def forget(klass, obj, interface, name):
+        for batch in getattr(klass.local, 'batches', ()):
+            batch.values.get(obj.object_path, {}).get(interface, {}).pop(name, None)
+
+def batch():
+    """Return a context manager in which properties of all objects are read
+       with one GetAll call per object and interface"""
+    return Batch()
+
+class Pipeline(object):
+    """Collects method calls and property reads, and then sends them all
+       at once without waiting for the replies in between. run() returns the
+       results in order, with exceptions for calls that failed."""
+    def __init__(self):
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def call(self, obj, method, *args):
+        """Add a call of obj.method(*args)"""
+        interface, attrib, arginfo = obj._method_info(method)
+        klass = type(obj).__name__
+        inargs = [x for x in arginfo if x.get('direction', 'in') == 'in']
+        outargs = [x for x in arginfo if x.get('direction', 'in') == 'out']
+        if len(args) != len(inargs):
+            raise TypeError("%s() takes %d arguments (%d given)" % (method, len(inargs), len(args)))
+        args = [fixups.converter('to_dbus', klass, method, x['name'], x['type'])(arg) for x, arg in zip(inargs, args)]
+        self.calls.append((obj, interface, method, args, ''.join([x['type'] for x in inargs]), fixups.reply_converter(klass, method, outargs)))
+        return len(self.calls) - 1
+
+    def get(self, obj, name):
+        """Add a read of the property obj.name"""
+        interface, attrib = obj._property_info(name)
+        convert = fixups.converter('to_python', type(obj).__name__, 'Get', name, attrib['type'])
+        self.calls.append((obj, 'org.freedesktop.DBus.Properties', 'Get', [interface, name], 'ss', lambda ret: convert(ret[0])))
+        return len(self.calls) - 1
+
+    def get_all(self, obj, interface):
+        """Add a read of all properties of an interface of obj, giving the
+           raw property values"""
+        self.calls.append((obj, 'org.freedesktop.DBus.Properties', 'GetAll', [interface], 's', lambda ret: ret[0]))
+        return len(self.calls) - 1
+
+    def run(self):
+        """Send all calls, wait for their replies and return the results"""
+        calls, self.calls = self.calls, []
+        replies = [None] * len(calls)
+        remaining = [len(calls)]
+        done = threading.Condition()
+        # Without a mainloop, replies arrive in the AsyncBus thread.
+        # Otherwise we run the mainloop until all replies are in.
+        threaded = not dbus.get_default_main_loop()
+        def finish(index, reply):
+            with done:
+                replies[index] = reply
+                remaining[0] -= 1
+                done.notify_all()
+        def handlers(index):
+            return (lambda *ret: finish(index, (True, ret)), lambda error: finish(index, (False, error)))
+        for index, (obj, interface, method, args, signature, convert) in enumerate(calls):
+            reply_handler, error_handler = handlers(index)
             try:
-                match == sender
-            except ObjectVanished:
-                to_delete.append(pos)
+                AsyncBus.call_async(obj, interface, method, args, signature, reply_handler, error_handler,
+                                    bus=None if threaded else dbus.SystemBus())
+            except Exception as e:
+                error_handler(e)
+        if not threaded:
+            from gi.repository import GLib
+            while remaining[0]:
+                GLib.MainContext.default().iteration(True)
+        with done:
+            while remaining[0]:
+                done.wait()
+        results = []
+        for (obj, interface, method, args, signature, convert), (ok, value) in zip(calls, replies):
+            try:
+                results.append(convert(value) if ok else AsyncBus.exception(obj, value))
+            except Exception as e:
+                results.append(e)
+        return results
+
+SignalEvent = collections.namedtuple('SignalEvent', ('object', 'interface', 'signal', 'args', 'received'))
+
+class EventStream(object):
+    """A queue of NetworkManager signals, which can be iterated over with
+       both for and async for. See NetworkManager.events()"""
+    overflow_policies = ('drop_oldest', 'coalesce')
+
+    def __init__(self, signals=None, objects=None, filter=None, maxsize=1000, overflow='drop_oldest'):
+        # Signals are received either in the AsyncBus thread or in the
+        # mainloop, and both are needed for other things too. So we can't
+        # make them wait for the consumer of this stream.
+        if overflow == 'block':
+            raise ValueError("The block overflow policy is not supported, as it would stall the thread that receives signals")
+        if overflow not in self.overflow_policies:
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+        # Without a mainloop of our own, signals are received in the
+        # AsyncBus thread. Otherwise they arrive in the mainloop, and waiting
+        # for them means running the mainloop.
+        self.threaded = not dbus.get_default_main_loop()
+        self.filter = filter
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.queue = collections.OrderedDict()
+        self.counter = 0
+        self.waiters = []
+        self.closed = False
+        self.lock = threading.Condition()
+        self.stats = {'received': 0, 'delivered': 0, 'dropped': 0, 'coalesced': 0, 'vanished': 0, 'last_lag': 0.0, 'max_lag': 0.0}
+        bus = AsyncBus.get_bus() if self.threaded else dbus.SystemBus()
+        self.matches = []
+        for obj in objects or [None]:
+            for signal in signals or [None]:
+                self.matches.append(bus.add_signal_receiver(self.push, signal, None, NMDbusInterfaceType.dbus_service, obj and obj.object_path,
+                    interface_keyword='interface', member_keyword='signal', path_keyword='path', byte_arrays=True))
+
+    def __len__(self):
+        return len(self.queue)
+
+    def close(self):
+        """Stop receiving signals. Events that are already queued can still
+           be consumed."""
+        for match in self.matches:
+            match.remove()
+        self.matches = []
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.wake, future, loop)
+
+    def push(self, *args, **kwargs):
+        event = [kwargs['path'], kwargs['interface'], kwargs['signal'], args, time.time()]
+        with self.lock:
+            if self.closed:
+                return
+            self.stats['received'] += 1
+            key = (event[0], event[1], event[2])
+            if event[1] == 'org.freedesktop.DBus.Properties' and event[2] == 'PropertiesChanged':
+                # Changes of different interfaces of an object are kept apart
+                key += (args[0],)
+            if self.overflow == 'coalesce' and key in self.queue:
+                self.queue[key] = self.coalesce(self.queue[key], event)
+                self.stats['coalesced'] += 1
+                return
+            if self.overflow != 'coalesce':
+                self.counter += 1
+                key = self.counter
+            while len(self.queue) >= self.maxsize:
+                self.queue.popitem(last=False)
+                self.stats['dropped'] += 1
+            self.queue[key] = event
+            self.lock.notify_all()
+            waiter = self.waiters and self.waiters.pop(0)
+        if waiter:
+            waiter[0].call_soon_threadsafe(self.wake, waiter[1], waiter[0])
+
+    def coalesce(self, old, new):
+        # Changed properties are merged, of other signals only the last one
+        # is kept. The event keeps its place in the queue.
+        if old[1] == new[1] == 'org.freedesktop.DBus.Properties' and old[2] == new[2] == 'PropertiesChanged':
+            changed = dict(old[3][1])
+            for name in new[3][2]:
+                changed.pop(name, None)
+            changed.update(new[3][1])
+            invalidated = [x for x in old[3][2] if x not in new[3][1]] + [x for x in new[3][2] if x not in old[3][2]]
+            new[3] = (new[3][0], changed, invalidated)
+        new[4] = old[4]
+        return new
+
+    def pop(self):
+        # Called with the lock held and a non-empty queue
+        event = self.queue.popitem(last=False)[1]
+        self.lock.notify_all()
+        lag = time.time() - event[4]
+        self.stats['delivered'] += 1
+        self.stats['last_lag'] = lag
+        self.stats['max_lag'] = max(self.stats['max_lag'], lag)
+        return event
+
+    def convert(self, event):
+        # Returns None if the event can't be converted because an object in
+        # its arguments went away before it was consumed.
+        path, interface, signal, args, received = event
+        try:
+            obj = fixups.base_to_python(dbus.ObjectPath(path))
+        except (dbus.exceptions.DBusException, ObjectVanished):
+            # The sender went away, give the object path instead
+            obj = six.text_type(path)
+        key = (interface, signal)
+        try:
+            if key == ('org.freedesktop.DBus.Properties', 'PropertiesChanged'):
+                args = {'interface_name': six.text_type(args[0]), 'changed_properties': fixups.properties_to_python(type(obj).__name__, fixups.base_to_python(args[1])),
+                        'invalidated_properties': fixups.base_to_python(args[2])}
+            elif key in SignalDispatcher.args:
+                sargs, args = SignalDispatcher.convert_args(key, type(obj).__name__, args)
+                for num, arg in enumerate(sargs):
+                    args['arg%d' % num] = arg
+            else:
+                args = dict([('arg%d' % num, fixups.base_to_python(arg)) for num, arg in enumerate(args)])
+        except (dbus.exceptions.DBusException, ObjectVanished):
+            with self.lock:
+                self.stats['vanished'] += 1
+            return None
+        return SignalEvent(obj, six.text_type(interface), six.text_type(signal), args, received)
+
+    def get(self, timeout=None):
+        """Wait for the next event, and return it. Returns None if there is
+           no event within timeout seconds or the stream is closed."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            event = None
+            with self.lock:
+                if self.queue:
+                    event = self.pop()
+                elif self.closed or (deadline is not None and time.time() >= deadline):
+                    return None
+                elif self.threaded:
+                    self.lock.wait(None if deadline is None else deadline - time.time())
+                    continue
+            if event is not None:
+                event = self.convert(event)
+                if event is not None and (self.filter is None or self.filter(event)):
+                    return event
                 continue
-            if match == sender:
-                rkwargs['interface'] = kwargs['interface']
-                rkwargs['signal'] = kwargs['signal']
-                rkwargs.update(skwargs)
-                receiver(sender, *(sargs + rargs), **rkwargs)
-        for pos in reversed(to_delete):
-            self.handlers[key].pop(pos)
+            from gi.repository import GLib
+            if not GLib.MainContext.default().iteration(deadline is None):
+                time.sleep(0.01)
 
-    def handle_restart(self, name, old, new):
-        if str(new) == "" or str(name) != 'org.freedesktop.NetworkManager':
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        event = self.get()
+        if event is None:
+            raise StopIteration
+        return event
+    next = __next__
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.wake(future, loop)
+        return future
+
+    def wake(self, future, loop):
+        # Resolve future with the next event, or wait for one
+        if future.cancelled():
             return
-        NMDbusInterface.last_disconnect = time.time()
-        time.sleep(1) # Give NetworkManager a bit of time to start and rediscover itself.
-        for key in self.handlers:
-            val, self.handlers[key] = self.handlers[key], []
-            for obj, func, args, kwargs in val:
-                try:
-                    # This resets the object path if needed
-                    obj.proxy
-                    self.add_signal_receiver(key[0], key[1], obj, func, args, kwargs)
-                except ObjectVanished:
-                    pass
-SignalDispatcher = SignalDispatcher()
+        while True:
+            with self.lock:
+                if not self.queue:
+                    if self.closed:
+                        future.set_exception(StopAsyncIteration())
+                    else:
+                        self.waiters.append((loop, future))
+                    return
+                event = self.pop()
+            try:
+                event = self.convert(event)
+                if event is not None and (self.filter is None or self.filter(event)):
+                    future.set_result(event)
+                    return
+            except Exception as e:
+                future.set_exception(e)
+                return
 
 # We completely dynamically generate all classes using introspection data. As
 # this is done at import time, use a special dbus connection that does not get
 # in the way of setting a mainloop and doing async stuff later.
 init_bus = dbus.SystemBus(private=True)
-xml_cache = {}
+
+# Introspecting objects and parsing the xml for every class on every import is
+# slow, so the parsed introspection data is cached on disk, keyed by interface
+# name and the version of the running NetworkManager. Set NM_INTROSPECTION_CACHE
+# to a directory to store the cache elsewhere, or to an empty string or 0 to
+# disable it.
+class IntrospectionCache(object):
+    def __init__(self):
+        self.interfaces = None
+        self.version = None
+        directory = os.environ.get('NM_INTROSPECTION_CACHE', None)
+        if directory is None:
+            if os.geteuid() == 0:
+                directory = '/var/cache/python-networkmanager'
+            else:
+                directory = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'python-networkmanager')
+        if directory in ('', '0'):
+            directory = None
+        self.directory = directory
+
+    def load(self, bus):
+        if self.interfaces is not None:
+            return
+        self.interfaces = {}
+        if not self.directory:
+            return
+        try:
+            proxy = bus.get_object(NMDbusInterfaceType.dbus_service, '/org/freedesktop/NetworkManager')
+            self.version = six.text_type(proxy.Get('org.freedesktop.NetworkManager', 'Version', dbus_interface='org.freedesktop.DBus.Properties'))
+            with open(os.path.join(self.directory, 'introspection.json')) as fd:
+                data = json.load(fd)
+        except (dbus.exceptions.DBusException, IOError, OSError, ValueError):
+            return
+        # A different NetworkManager version may have a different interface
+        if data.get('version') == self.version:
+            self.interfaces = data['interfaces']
+
+    def save(self):
+        if not self.directory or not self.version:
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as fd:
+                json.dump({'version': self.version, 'interfaces': self.interfaces}, fd)
+            os.rename(tmp, os.path.join(self.directory, 'introspection.json'))
+        except (IOError, OSError):
+            pass
+
+    def invalidate(self):
+        # Called when NetworkManager restarts, it may have been upgraded
+        self.interfaces = None
+        self.version = None
+
+    def introspect(self, bus, object_path, interface_names):
+        self.load(bus)
+        if not all(name in self.interfaces for name in interface_names):
+            proxy = bus.get_object(NMDbusInterfaceType.dbus_service, object_path)
+            xml = proxy.Introspect(dbus_interface='org.freedesktop.DBus.Introspectable')
+            interfaces = self.parse(xml)
+            if not any(name.startswith(NMDbusInterfaceType.dbus_service) for name in interfaces):
+                # The object went away before we could introspect it. Don't
+                # remember anything, so the next object is introspected again.
+                return {}
+            # Remember which interfaces this object does not have, so we don't
+            # introspect again for them.
+            for name in interface_names:
+                interfaces.setdefault(name, None)
+            self.interfaces.update(interfaces)
+            self.save()
+        return dict([(name, self.interfaces[name]) for name in interface_names])
+
+    @staticmethod
+    def parse(xml):
+        interfaces = {}
+        for element in etree.fromstring(xml):
+            if element.tag != 'interface':
+                continue
+            data = interfaces[element.attrib['name']] = {'properties': [], 'methods': [], 'signals': []}
+            for item in element:
+                args = [dict(arg.attrib) for arg in item if arg.tag == 'arg']
+                if item.tag == 'property':
+                    data['properties'].append(dict(item.attrib))
+                elif item.tag == 'method':
+                    data['methods'].append([dict(item.attrib), args])
+                elif item.tag == 'signal':
+                    data['signals'].append([dict(item.attrib), args])
+        return interfaces
+IntrospectionCache = IntrospectionCache()
+
+# Several fixer methods to make the data easier to handle in python
+# - SSID sent/returned as bytes (only encoding tried is utf-8)
+# - IP, Mac address and route metric encoding/decoding
+class fixups(object):
+    # Which conversions apply to a value only depends on where it comes from
+    # or goes to, so we figure that out once and cache the resulting function
+    # for each (direction, class, method, argument, signature).
+    converters = {}
+
+    @staticmethod
+    def converter(direction, klass, method, arg, signature):
+        key = (direction, klass, method, arg, signature)
+        if key not in fixups.converters:
+            if direction == 'to_dbus':
+                fixups.converters[key] = fixups.make_to_dbus(klass, method, arg, signature)
+            else:
+                fixups.converters[key] = fixups.make_to_python(klass, method, arg, signature)
+        return fixups.converters[key]
+
+    @staticmethod
+    def to_dbus(klass, method, arg, val, signature):
+        return fixups.converter('to_dbus', klass, method, arg, signature)(val)
+
+    # Property values are sent as variants, so dbus can't know which type to
+    # use for them unless we tell it.
+    variant_types = {'s': dbus.String, 'g': dbus.Signature, 'b': dbus.Boolean, 'y': dbus.Byte, 'n': dbus.Int16, 'q': dbus.UInt16,
+                     'i': dbus.Int32, 'u': dbus.UInt32, 'x': dbus.Int64, 't': dbus.UInt64, 'd': dbus.Double}
+    # Values of these types are already encoded and are passed as they are.
+    # dbus strings are not, they may still need parsing (e.g. mac addresses).
+    dbus_types = (dbus.ByteArray, dbus.Array, dbus.Struct, dbus.Dictionary, dbus.Boolean, dbus.Byte, dbus.Int16,
+                  dbus.UInt16, dbus.Int32, dbus.UInt32, dbus.Int64, dbus.UInt64, dbus.Double)
+
+    @staticmethod
+    def make_to_dbus(klass, method, arg, signature):
+        if arg in ('connection' 'properties') and signature == 'a{sa{sv}}':
+            return fixups.settings_to_dbus
+        if method == 'Set' and signature in fixups.variant_types:
+            return fixups.variant_types[signature]
+        if method == 'Set' and signature == 'o':
+            return lambda val: dbus.ObjectPath(val.object_path if isinstance(val, NMDbusInterface) else val)
+        if signature == 'o':
+            return lambda val: val.object_path if isinstance(val, NMDbusInterface) else val
+        if signature in ('s', 'g', 'b', 'y', 'n', 'q', 'i', 'u', 'x', 't', 'd', 'h'):
+            return lambda val: val
+        return fixups.base_to_dbus
+
+    @staticmethod
+    def settings_to_dbus(settings):
+        # Build the result in a single pass instead of fixing up a deep copy
+        # of the input. Empty arrays/dicts are left out. dbus barfs on them
+        # (can't guess signatures), and if they were to get through,
+        # NetworkManager ignores them anyway.
+        ret = {}
+        for name, setting in settings.items():
+            if not isinstance(setting, dict):
+                if setting not in ({}, []):
+                    ret[name] = fixups.base_to_dbus(setting)
+                continue
+            encoded = {}
+            for key, value in setting.items():
+                if (name, key) not in fixups.setting_encoders:
+                    fixups.setting_encoders[(name, key)] = fixups.make_setting_encoder(name, key)
+                if not isinstance(value, fixups.dbus_types):
+                    value = fixups.setting_encoders[(name, key)](value)
+                if value not in ({}, []):
+                    encoded[key] = value
+            if encoded:
+                ret[name] = encoded
+        return ret
+
+    # (setting name, key) -> function to encode its values
+    setting_encoders = {}
+
+    @staticmethod
+    def make_setting_encoder(name, key):
+        if key in ('mac-address', 'cloned-mac-address', 'bssid'):
+            return fixups.mac_to_dbus
+        if key in ('ca-cert', 'client-cert', 'phase2-ca-cert', 'phase2-client-cert', 'private-key'):
+            return fixups.cert_to_dbus
+        if name == '802-11-wireless' and key == 'ssid':
+            return fixups.ssid_to_dbus
+        family = {'ipv4': socket.AF_INET, 'ipv6': socket.AF_INET6}.get(name, None)
+        if family and key in ('address-data', 'route-data'):
+            return fixups.data_to_dbus
+        if family and key == 'addresses':
+            return lambda val: [fixups.addrconf_to_dbus(addr, family) for addr in val]
+        if family and key == 'routes':
+            return lambda val: [fixups.route_to_dbus(route, family) for route in val]
+        if family and key == 'dns':
+            return lambda val: [fixups.addr_to_dbus(addr, family) for addr in val]
+        return fixups.base_to_dbus
+
+    @staticmethod
+    def data_to_dbus(data):
+        return dbus.Array([dict(item, prefix=dbus.UInt32(item['prefix'])) for item in data], signature=dbus.Signature('a{sv}'))
+
+    @staticmethod
+    def base_to_dbus(val):
+        if isinstance(val, NMDbusInterface):
+            return val.object_path
+        # Strings and numbers are passed as they are
+        if isinstance(val, six.string_types + six.integer_types + (float,)):
+            return val
+        if hasattr(val.__class__, 'mro'):
+            for klass in val.__class__.mro():
+                if klass.__module__ in ('dbus', '_dbus_bindings'):
+                    return val
+        # Binary data is an ay, not a list of integers
+        if isinstance(val, (bytes, bytearray)):
+            return dbus.ByteArray(bytes(val))
+        if hasattr(val, '__iter__') and not isinstance(val, six.string_types):
+            if hasattr(val, 'items'):
+                return dict([(x, fixups.base_to_dbus(y)) for x, y in val.items()])
+            else:
+                return [fixups.base_to_dbus(x) for x in val]
+        return val
+
+    @staticmethod
+    def to_python(klass, method, arg, val, signature):
+        return fixups.converter('to_python', klass, method, arg, signature)(val)
+
+    @staticmethod
+    def reply_converter(klass, method, outargs):
+        """Return a function that converts the list of return values of a
+           method call the same way generated methods do"""
+        to_python = [fixups.converter('to_python', klass, method, x['name'], x['type']) for x in outargs]
+        def convert(ret):
+            ret = [func(value) for func, value in zip(to_python, ret)]
+            if len(ret) == 1:
+                return ret[0]
+            return tuple(ret) or None
+        return convert
+
+    @staticmethod
+    def make_to_python(klass, method, arg, signature):
+        base = fixups.signature_to_python(signature)
+        fixup = None
+        if method == 'Get' and arg == 'Strength' and signature == 'y':
+            return int
+        if method == 'Get':
+            af = {'IP4Config': socket.AF_INET, 'IP6Config': socket.AF_INET6}.get(klass, socket.AF_INET)
+            fixup = {
+                'Ip4Address': lambda val: fixups.addr_to_python(val, socket.AF_INET),
+                'Ip6Address': lambda val: fixups.addr_to_python(val, socket.AF_INET6),
+                'Ssid': fixups.ssid_to_python,
+                'Strength': fixups.strength_to_python,
+                'Addresses': lambda val: [fixups.addrconf_to_python(addr, af) for addr in val],
+                'Routes': lambda val: [fixups.route_to_python(route, af) for route in val],
+                'Nameservers': lambda val: [fixups.addr_to_python(addr, af) for addr in val],
+                'WinsServers': lambda val: [fixups.addr_to_python(addr, af) for addr in val],
+                'Options': fixups.options_to_python,
+            }.get(arg, None)
+        elif method == 'GetSettings':
+            fixup = fixups.settings_to_python
+        elif method == 'PropertiesChanged':
+            fixup = lambda val: fixups.properties_to_python(klass, val)
+        if fixup is None:
+            return base
+        return lambda val: fixup(base(val))
+
+    @staticmethod
+    def signature_to_python(signature):
+        # Values of a known basic type don't need to go through all the
+        # checks in base_to_python
+        if signature in ('s', 'g'):
+            return six.text_type
+        if signature == 'b':
+            return bool
+        if signature in ('n', 'q', 'i', 'u', 'x', 't'):
+            return int
+        if signature == 'y':
+            return lambda val: six.int2byte(int(val))
+        if signature in ('d', 'h'):
+            return lambda val: val
+        if signature == 'o':
+            return fixups.path_to_python
+        if signature and signature.startswith('a{'):
+            key, value = [fixups.signature_to_python(x) for x in fixups.split_signature(signature[2:-1])]
+            return lambda val: dict([(key(x), value(y)) for x, y in val.items()])
+        if signature == 'ay':
+            return fixups.bytes_to_python
+        if signature and signature.startswith('a'):
+            item = fixups.signature_to_python(signature[1:])
+            return lambda val: [item(x) for x in val]
+        if signature and signature.startswith('('):
+            items = [fixups.signature_to_python(x) for x in fixups.split_signature(signature[1:-1])]
+            return lambda val: [item(x) for item, x in zip(items, val)]
+        return fixups.base_to_python
+
+    @staticmethod
+    def split_signature(signature):
+        """Split a signature into its complete types"""
+        ret = []
+        while signature:
+            end = 0
+            while signature[end] == 'a':
+                end += 1
+            if signature[end] in '({':
+                depth = 0
+                for end in range(end, len(signature)):
+                    depth += {'(': 1, '{': 1, ')': -1, '}': -1}.get(signature[end], 0)
+                    if not depth:
+                        break
+            ret.append(signature[:end+1])
+            signature = signature[end+1:]
+        return ret
+
+    @staticmethod
+    def options_to_python(val):
+        for key in val:
+            if key.startswith('requested_'):
+                val[key] = bool(int(val[key]))
+            elif val[key].isdigit():
+                val[key] = int(val[key])
+            elif key in ('domain_name_servers', 'ntp_servers', 'routers'):
+                val[key] = val[key].split()
+        return val
+
+    @staticmethod
+    def settings_to_python(val):
+        if 'ssid' in val.get('802-11-wireless', {}):
+            val['802-11-wireless']['ssid'] = fixups.ssid_to_python(val['802-11-wireless']['ssid'])
+        for key in val:
+            val_ = val[key]
+            if 'mac-address' in val_:
+                val_['mac-address'] = fixups.mac_to_python(val_['mac-address'])
+            if 'cloned-mac-address' in val_:
+                val_['cloned-mac-address'] = fixups.mac_to_python(val_['cloned-mac-address'])
+            if 'bssid' in val_:
+                val_['bssid'] = fixups.mac_to_python(val_['bssid'])
+        if 'ipv4' in val:
+            val['ipv4']['addresses'] = [fixups.addrconf_to_python(addr,socket.AF_INET) for addr in val['ipv4']['addresses']]
+            val['ipv4']['routes'] = [fixups.route_to_python(route,socket.AF_INET) for route in val['ipv4']['routes']]
+            val['ipv4']['dns'] = [fixups.addr_to_python(addr,socket.AF_INET) for addr in val['ipv4']['dns']]
+        if 'ipv6' in val:
+            val['ipv6']['addresses'] = [fixups.addrconf_to_python(addr,socket.AF_INET6) for addr in val['ipv6']['addresses']]
+            val['ipv6']['routes'] = [fixups.route_to_python(route,socket.AF_INET6) for route in val['ipv6']['routes']]
+            val['ipv6']['dns'] = [fixups.addr_to_python(addr,socket.AF_INET6) for addr in val['ipv6']['dns']]
+        return val
+
+    @staticmethod
+    def properties_to_python(klass, val):
+        # Also used for the generic PropertiesChanged signal, whose first
+        # argument is the interface name.
+        if not isinstance(val, dict):
+            return val
+        for prop in val:
+            val[prop] = fixups.converter('to_python', klass, 'Get', prop, None)(val[prop])
+        return val
+
+    @staticmethod
+    def base_to_python(val):
+        if isinstance(val, dbus.ByteArray):
+            return bytes(val)
+        if isinstance(val, dbus.Array) and val.signature == 'y':
+            return fixups.bytes_to_python(val)
+        if isinstance(val, (dbus.Array, list, tuple)):
+            return [fixups.base_to_python(x) for x in val]
+        if isinstance(val, (dbus.Dictionary, dict)):
+            return dict([(fixups.base_to_python(x), fixups.base_to_python(y)) for x,y in val.items()])
+        if isinstance(val, dbus.ObjectPath):
+            return fixups.path_to_python(val)
+        if isinstance(val, (dbus.Signature, dbus.String)):
+            return six.text_type(val)
+        if isinstance(val, dbus.Boolean):
+            return bool(val)
+        if isinstance(val, (dbus.Int16, dbus.UInt16, dbus.Int32, dbus.UInt32, dbus.Int64, dbus.UInt64)):
+            return int(val)
+        if isinstance(val, dbus.Byte):
+            return six.int2byte(int(val))
+        return val
+
+    @staticmethod
+    def path_to_python(val):
+        for obj in (NetworkManager, Settings, AgentManager):
+            if val == obj.object_path:
+                return obj
+        if val.startswith('/org/freedesktop/NetworkManager/'):
+            # Return the same object for the same path, as long as it's
+            # still in use
+            obj = NMDbusInterface.instances.get(val, None)
+            if obj is None:
+                classname = val.split('/')[4]
+                classname = {
+                   'Settings': 'Connection',
+                   'Devices': 'Device',
+                }.get(classname, classname)
+                obj = globals()[classname](val)
+                NMDbusInterface.instances[six.text_type(val)] = obj
+            return obj
+        if val == '/':
+            return None
+        return val
+
+    @staticmethod
+    def bytes_to_python(val):
+        # Byte arrays are normally received as dbus.ByteArray, but may also
+        # be a list of bytes if they weren't requested with byte_arrays=True
+        if isinstance(val, bytes):
+            return bytes(val)
+        if val and isinstance(val[0], bytes):
+            return bytes().join(val)
+        return bytes(bytearray(val))
+
+    @staticmethod
+    def ssid_to_python(ssid):
+        ssid = fixups.bytes_to_python(ssid)
+        try:
+            return ssid.decode('utf-8')
+        except UnicodeDecodeError:
+            ssid = ssid.decode('utf-8', 'replace')
+            warnings.warn("Unable to decode ssid %s properly" % ssid, UnicodeWarning)
+            return ssid
+
+    @staticmethod
+    def ssid_to_dbus(ssid):
+        if isinstance(ssid, six.text_type):
+            ssid = ssid.encode('utf-8')
+        return dbus.ByteArray(fixups.bytes_to_python(ssid))
+
+    @staticmethod
+    def strength_to_python(strength):
+        if isinstance(strength, bytes):
+            return struct.unpack('B', strength)[0]
+        return int(strength)
+
+    @staticmethod
+    def mac_to_python(mac):
+        return "%02X:%02X:%02X:%02X:%02X:%02X" % tuple(bytearray(fixups.bytes_to_python(mac)))
+
+    @staticmethod
+    def mac_to_dbus(mac):
+        if isinstance(mac, fixups.dbus_types):
+            return mac
+        return dbus.ByteArray(bytes(bytearray([int(x, 16) for x in mac.split(':')])))
+
+    @staticmethod
+    def addrconf_to_python(addrconf,family):
+        addr, netmask, gateway = addrconf
+        return [
+            fixups.addr_to_python(addr,family),
+            netmask,
+            fixups.addr_to_python(gateway,family)
+        ]
+
+    @staticmethod
+    def addrconf_to_dbus(addrconf,family):
+        if isinstance(addrconf, fixups.dbus_types):
+            return addrconf
+        addr, netmask, gateway = addrconf
+        if (family == socket.AF_INET):
+            return [
+                fixups.addr_to_dbus(addr,family),
+                fixups.mask_to_dbus(netmask),
+                fixups.addr_to_dbus(gateway,family)
+            ]
+        else:
+            return dbus.Struct(
+                (
+                    fixups.addr_to_dbus(addr,family),
+                    fixups.mask_to_dbus(netmask),
+                    fixups.addr_to_dbus(gateway,family)
+                ), signature = 'ayuay'
+            )
+
+    @staticmethod
+    def addr_to_python(addr,family):
+        if (family == socket.AF_INET):
+            return socket.inet_ntop(family,struct.pack('I', addr))
+        else:
+            return socket.inet_ntop(family,fixups.bytes_to_python(addr))
+
+    @staticmethod
+    def addr_to_dbus(addr,family):
+        if isinstance(addr, fixups.dbus_types):
+            return addr
+        if (family == socket.AF_INET):
+            return dbus.UInt32(struct.unpack('I', socket.inet_pton(family,addr))[0])
+        else:
+            return dbus.ByteArray(socket.inet_pton(family,addr))
+
+    @staticmethod
+    def mask_to_dbus(mask):
+        return dbus.UInt32(mask)
+
+    @staticmethod
+    def route_to_python(route,family):
+        addr, netmask, gateway, metric = route
+        return [
+            fixups.addr_to_python(addr,family),
+            netmask,
+            fixups.addr_to_python(gateway,family),
+            metric
+        ]
+
+    @staticmethod
+    def route_to_dbus(route,family):
+        if isinstance(route, fixups.dbus_types):
+            return route
+        addr, netmask, gateway, metric = route
+        return [
+            fixups.addr_to_dbus(addr,family),
+            fixups.mask_to_dbus(netmask),
+            fixups.addr_to_dbus(gateway,family),
+            metric
+        ]
+
+    @staticmethod
+    def cert_to_dbus(cert):
+        if not isinstance(cert, bytes):
+            if not cert.startswith('file://'):
+                cert = 'file://' + cert
+            cert = cert.encode('utf-8') + b'\0'
+        return dbus.ByteArray(cert)
 
 class NMDbusInterfaceType(type):
     """Metaclass that generates our classes based on introspection data"""
@@ -128,49 +1350,68 @@ class NMDbusInterfaceType(type):
                     attrs['interface_names'] += base.interface_names
                     break
 
-        if 'interface_names' in attrs:
-            SignalDispatcher.interfaces.update(attrs['interface_names'])
-
         # If we know where to find this object, let's introspect it and
         # generate properties and methods
         if 'object_path' in attrs and attrs['object_path']:
-            proxy = init_bus.get_object(type_.dbus_service, attrs['object_path'])
-            attrs['introspection_data'] = proxy.Introspect(dbus_interface='org.freedesktop.DBus.Introspectable')
-            root = etree.fromstring(attrs['introspection_data'])
-            for element in root:
-                if element.tag == 'interface' and element.attrib['name'] in attrs['interface_names']:
-                    for item in element:
-                        if item.tag == 'property':
-                            attrs[item.attrib['name']] = type_.make_property(name, element.attrib['name'], item.attrib)
-                            attrs['properties'].append(item.attrib['name'])
-                        elif item.tag == 'method':
-                            aname = item.attrib['name']
-                            if aname in attrs:
-                                aname = '_' + aname
-                            attrs[aname] = type_.make_method(name, element.attrib['name'], item.attrib, list(item))
-                        elif item.tag == 'signal':
-                            SignalDispatcher.args[(element.attrib['name'], item.attrib['name'])] = [(arg.attrib.get('name',None), arg.attrib['type']) for arg in item]
-                            attrs['On' + item.attrib['name']] = type_.make_signal(name, element.attrib['name'], item.attrib)
-                            attrs['signals'].append(item.attrib['name'])
+            attrs['introspection_data'] = IntrospectionCache.introspect(init_bus, attrs['object_path'], attrs['interface_names'])
+            for kind, member, aname, value in type_.make_members(name, attrs['introspection_data'], lambda aname: aname in attrs):
+                attrs[aname] = value
+                if kind == 'property':
+                    attrs['properties'].append(member)
+                elif kind == 'signal':
+                    attrs['signals'].append(member)
 
         klass = super(NMDbusInterfaceType, type_).__new__(type_, name, bases, attrs)
         return klass
 
+    @staticmethod
+    def make_members(klass, interfaces, exists):
+        """Generate properties, methods and signals for the given interfaces"""
+        for interface, data in interfaces.items():
+            if not data:
+                continue
+            for attrib in data['properties']:
+                yield 'property', attrib['name'], attrib['name'], NMDbusInterfaceType.make_property(klass, interface, attrib)
+            for attrib, args in data['methods']:
+                aname = attrib['name']
+                if exists(aname):
+                    aname = '_' + aname
+                yield 'method', attrib['name'], aname, NMDbusInterfaceType.make_method(klass, interface, attrib, args)
+                yield 'method', attrib['name'] + '_async', aname + '_async', NMDbusInterfaceType.make_async_method(klass, interface, attrib, args)
+            for attrib, args in data['signals']:
+                SignalDispatcher.args[(interface, attrib['name'])] = [(arg.get('name', None), arg['type']) for arg in args]
+                yield 'signal', attrib['name'], 'On' + attrib['name'], NMDbusInterfaceType.make_signal(klass, interface, attrib)
+
     @staticmethod
     def make_property(klass, interface, attrib):
         name = attrib['name']
+        to_python = fixups.converter('to_python', klass, 'Get', name, attrib['type'])
+        to_dbus = fixups.converter('to_dbus', klass, 'Set', name, attrib['type'])
         def get_func(self):
+            cache = self._cache
+            if cache is None:
+                cache = Batch.cache(self)
+            if cache is not None:
+                if interface not in cache:
+                    cache[interface] = dict(self._get_all(interface))
+                if name in cache[interface]:
+                    return to_python(cache[interface][name])
             try:
-                data = self.proxy.Get(interface, name, dbus_interface='org.freedesktop.DBus.Properties')
+                data = self.proxy.Get(interface, name, dbus_interface='org.freedesktop.DBus.Properties', byte_arrays=True)
             except dbus.exceptions.DBusException as e:
                 if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
                     raise ObjectVanished(self)
                 raise
-            return fixups.to_python(klass, 'Get', name, data, attrib['type'])
+            if cache is not None and interface in cache:
+                cache[interface][name] = data
+            return to_python(data)
         if attrib['access'] == 'read':
             return property(get_func)
         def set_func(self, value):
-            value = fixups.to_dbus(klass, 'Set', name, value, attrib['type'])
+            value = to_dbus(value)
+            if self._cache is not None and interface in self._cache:
+                self._cache[interface].pop(name, None)
+            Batch.forget(self, interface, name)
             try:
                 return self.proxy.Set(interface, name, value, dbus_interface='org.freedesktop.DBus.Properties')
             except dbus.exceptions.DBusException as e:
@@ -182,36 +1423,58 @@ class NMDbusInterfaceType(type):
     @staticmethod
     def make_method(klass, interface, attrib, args):
         name = attrib['name']
-        outargs = [x for x in args if x.tag == 'arg' and x.attrib['direction'] == 'out']
-        outargstr = ', '.join([x.attrib['name'] for x in outargs]) or 'ret'
-        args = [x for x in args if x.tag == 'arg' and x.attrib['direction'] == 'in']
-        argstr = ', '.join([x.attrib['name'] for x in args])
+        outargs = [x for x in args if x.get('direction', 'in') == 'out']
+        outargstr = ', '.join([x['name'] for x in outargs]) or 'ret'
+        args = [x for x in args if x.get('direction', 'in') == 'in']
+        argstr = ', '.join([x['name'] for x in args])
+        # The generated function gets the converters for its arguments in its
+        # namespace, so calling it does no lookups.
         ret = {}
+        namespace = {'dbus': dbus, 'ObjectVanished': ObjectVanished}
         code = "def %s(self%s):\n" % (name, ', ' + argstr if argstr else '')
         for arg in args:
-            argname = arg.attrib['name']
-            signature = arg.attrib['type']
-            code += "    %s = fixups.to_dbus('%s', '%s', '%s', %s, '%s')\n" % (argname, klass, name, argname, argname, signature)
+            argname = arg['name']
+            namespace['to_dbus_' + argname] = fixups.converter('to_dbus', klass, name, argname, arg['type'])
+            code += "    %s = to_dbus_%s(%s)\n" % (argname, argname, argname)
         code += "    try:\n"
-        code += "        %s = dbus.Interface(self.proxy, '%s').%s(%s)\n" % (outargstr, interface, name, argstr)
+        code += "        %s = dbus.Interface(self.proxy, '%s').%s(%s)\n" % (outargstr, interface, name, argstr + ', byte_arrays=True' if argstr else 'byte_arrays=True')
         code += "    except dbus.exceptions.DBusException as e:\n"
         code += "        if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':\n"
         code += "            raise ObjectVanished(self)\n"
         code += "        raise\n"
         for arg in outargs:
-            argname = arg.attrib['name']
-            signature = arg.attrib['type']
-            code += "    %s = fixups.to_python('%s', '%s', '%s', %s, '%s')\n" % (argname, klass, name, argname, argname, signature)
+            argname = arg['name']
+            namespace['to_python_' + argname] = fixups.converter('to_python', klass, name, argname, arg['type'])
+            code += "    %s = to_python_%s(%s)\n" % (argname, argname, argname)
         code += "    return (%s)" % outargstr
-        exec(code, globals(), ret)
+        exec(code, namespace, ret)
         return ret[name]
 
+    @staticmethod
+    def make_async_method(klass, interface, attrib, args):
+        # Like make_method, but the generated function returns an asyncio
+        # future.
+        name = attrib['name']
+        outargs = [x for x in args if x.get('direction', 'in') == 'out']
+        args = [x for x in args if x.get('direction', 'in') == 'in']
+        argstr = ', '.join([x['name'] for x in args])
+        ret = {}
+        namespace = {'AsyncBus': AsyncBus, 'convert': fixups.reply_converter(klass, name, outargs)}
+        code = "def %s_async(self%s):\n" % (name, ', ' + argstr if argstr else '')
+        for arg in args:
+            argname = arg['name']
+            namespace['to_dbus_' + argname] = fixups.converter('to_dbus', klass, name, argname, arg['type'])
+            code += "    %s = to_dbus_%s(%s)\n" % (argname, argname, argname)
+        code += "    return AsyncBus.call(self, '%s', '%s', [%s], '%s', convert)" % (interface, name, argstr, ''.join([x['type'] for x in args]))
+        exec(code, namespace, ret)
+        return ret[name + '_async']
+
     @staticmethod
     def make_signal(klass, interface, attrib):
         name = attrib['name']
         ret = {}
         code = "def On%s(self, func, *args, **kwargs):" % name
-        code += "    SignalDispatcher.add_signal_receiver('%s', '%s', self, func, list(args), kwargs)"  % (interface, name)
+        code += "    return SignalDispatcher.add_signal_receiver('%s', '%s', self, func, list(args), kwargs)"  % (interface, name)
         exec(code, globals(), ret)
         return ret['On' + name]
 
@@ -220,28 +1483,23 @@ class NMDbusInterface(object):
     object_path = None
     last_disconnect = 0
     is_transient = False
+    snapshot_types = {}
+    # Object path -> object, so the same path maps to the same python object
+    instances = weakref.WeakValueDictionary()
+    # Object path -> class for devices and active connections. Paths are never
+    # reused for a different type of object while NetworkManager runs.
+    specializations = {}
 
     def __new__(klass, object_path=None):
         # If we didn't introspect this one at definition time, let's do it now.
         if object_path and not klass.introspection_data:
-            proxy = dbus.SystemBus().get_object(klass.dbus_service, object_path)
-            klass.introspection_data = proxy.Introspect(dbus_interface='org.freedesktop.DBus.Introspectable')
-            root = etree.fromstring(klass.introspection_data)
-            for element in root:
-                if element.tag == 'interface' and element.attrib['name'] in klass.interface_names:
-                    for item in element:
-                        if item.tag == 'property':
-                            setattr(klass, item.attrib['name'], type(klass).make_property(klass.__name__, element.attrib['name'], item.attrib))
-                            klass.properties.append(item.attrib['name'])
-                        elif item.tag == 'method':
-                            aname = item.attrib['name']
-                            if hasattr(klass, aname):
-                                aname = '_' + aname
-                            setattr(klass, aname, type(klass).make_method(klass.__name__, element.attrib['name'], item.attrib, list(item)))
-                        elif item.tag == 'signal':
-                            SignalDispatcher.args[(element.attrib['name'], item.attrib['name'])] = [(arg.attrib.get('name',None), arg.attrib['type']) for arg in item]
-                            setattr(klass, 'On' + item.attrib['name'], type(klass).make_signal(klass.__name__, element.attrib['name'], item.attrib))
-                            klass.signals.append(item.attrib['name'])
+            klass.introspection_data = IntrospectionCache.introspect(dbus.SystemBus(), object_path, klass.interface_names)
+            for kind, member, aname, value in type(klass).make_members(klass.__name__, klass.introspection_data, lambda aname: hasattr(klass, aname)):
+                setattr(klass, aname, value)
+                if kind == 'property':
+                    klass.properties.append(member)
+                elif kind == 'signal':
+                    klass.signals.append(member)
 
         SignalDispatcher.listen_for_restarts()
         return super(NMDbusInterface, klass).__new__(klass)
@@ -251,6 +1509,7 @@ class NMDbusInterface(object):
             object_path = object_path.object_path
         self.object_path = self.object_path or object_path
         self._proxy = None
+        self._cache = None
 
     def __eq__(self, other):
         return isinstance(other, NMDbusInterface) and self.object_path and other.object_path == self.object_path
@@ -270,10 +1529,103 @@ class NMDbusInterface(object):
             self._proxy.created = time.time()
         return self._proxy
 
+    def _method_info(self, name):
+        for interface, data in (self.introspection_data or {}).items():
+            for attrib, args in (data or {}).get('methods', []):
+                if attrib['name'] == name:
+                    return interface, attrib, args
+        raise AttributeError(name)
+
+    def _property_info(self, name):
+        for interface, data in (self.introspection_data or {}).items():
+            for attrib in (data or {}).get('properties', []):
+                if attrib['name'] == name:
+                    return interface, attrib
+        raise AttributeError(name)
+
+    def aget(self, name):
+        """Read a property without blocking, returns an asyncio future"""
+        interface, attrib = self._property_info(name)
+        convert = fixups.converter('to_python', type(self).__name__, 'Get', name, attrib['type'])
+        if self._cache is not None and name in self._cache.get(interface, {}):
+            return AsyncBus.done(convert(self._cache[interface][name]))
+        return AsyncBus.call(self, 'org.freedesktop.DBus.Properties', 'Get', [interface, name], 'ss', lambda ret: convert(ret[0]))
+
+    def aset(self, name, value):
+        """Set a property without blocking, returns an asyncio future"""
+        interface, attrib = self._property_info(name)
+        value = fixups.converter('to_dbus', type(self).__name__, 'Set', name, attrib['type'])(value)
+        if self._cache is not None and interface in self._cache:
+            self._cache[interface].pop(name, None)
+        return AsyncBus.call(self, 'org.freedesktop.DBus.Properties', 'Set', [interface, name, value], 'ssv', lambda ret: None)
+
+    def get_all(self):
+        """Fetch all properties of this object, using one GetAll call per
+           interface instead of one Get call per property"""
+        ret = {}
+        raw = {}
+        klass = type(self).__name__
+        for interface in self.interface_names:
+            if not (self.introspection_data or {}).get(interface):
+                continue
+            raw[interface] = self._get_all(interface)
+            for name, value in raw[interface].items():
+                ret[six.text_type(name)] = fixups.to_python(klass, 'Get', name, value, None)
+        # This remembers the specialization of devices and active connections
+        object_class(self.object_path, raw)
+        return ret
+
+    def batch(self):
+        """Return a context manager in which properties of this object are
+           read with one GetAll call per interface"""
+        return Batch(self)
+
+    def snapshot(self):
+        """Like get_all, but returns an immutable record with the properties as
+           attributes"""
+        values = self.get_all()
+        key = (type(self), tuple(sorted(values)))
+        if key not in self.snapshot_types:
+            self.snapshot_types[key] = collections.namedtuple(type(self).__name__ + 'Snapshot', key[1])
+        return self.snapshot_types[key](**values)
+
+    def cache_properties(self, enable=True):
+        """Keep a local copy of all properties, which is kept up to date with
+           the PropertiesChanged signal. This needs a mainloop."""
+        if not enable:
+            SignalDispatcher.unwatch_properties(self)
+            self._cache = None
+            return
+        if not dbus.get_default_main_loop():
+            raise RuntimeError("Caching properties requires a mainloop")
+        SignalDispatcher.watch_properties(self)
+        self._cache = {}
+        for interface in self.interface_names:
+            if (self.introspection_data or {}).get(interface):
+                self._cache[interface] = dict(self._get_all(interface))
+
+    def _get_all(self, interface):
+        try:
+            return self.proxy.GetAll(interface, dbus_interface='org.freedesktop.DBus.Properties', byte_arrays=True)
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
+                SignalDispatcher.unwatch_properties(self)
+                self._cache = None
+                raise ObjectVanished(self)
+            raise
+
     # Backwards compatibility interface
     def connect_to_signal(self, signal, handler, *args, **kwargs):
         return getattr(self, 'On' + signal)(handler, *args, **kwargs)
 
+    @classmethod
+    def connect_to_all(klass, signal, handler, *args, **kwargs):
+        """Receive a signal from all objects of this class, not just one"""
+        interfaces = [x for x in klass.interface_names if (x, signal) in SignalDispatcher.args] or klass.interface_names
+        handler = SignalHandler([(interface, signal) for interface in interfaces], klass, handler, list(args), kwargs)
+        SignalDispatcher.register(handler)
+        return handler
+
 class TransientNMDbusInterface(NMDbusInterface):
     is_transient = True
 
@@ -286,6 +1638,37 @@ class NetworkManager(NMDbusInterface):
     def auto_reconnect(self):
         pass
 
+    def events(self, signals=None, objects=None, filter=None, maxsize=1000, overflow='drop_oldest'):
+        """Return an EventStream of the signals sent by NetworkManager,
+           optionally limited to the given signal names and objects, and to
+           the events for which filter(event) is true."""
+        return EventStream(signals, objects, filter, maxsize, overflow)
+
+    def snapshot_all(self):
+        """Fetch all objects and their properties with a single
+           GetManagedObjects call. Returns a dict mapping object paths to
+           objects whose properties are served from the fetched data."""
+        proxy = dbus.SystemBus().get_object(self.dbus_service, '/org/freedesktop')
+        try:
+            data = proxy.GetManagedObjects(dbus_interface='org.freedesktop.DBus.ObjectManager', byte_arrays=True)
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownMethod':
+                raise ObjectVanished(self)
+            raise
+        ret = {}
+        for path, interfaces in data.items():
+            if path in (NetworkManager.object_path, Settings.object_path, AgentManager.object_path):
+                # Don't touch the singletons, they must stay live
+                obj = type(fixups.base_to_python(path))()
+            else:
+                klass = object_class(path, interfaces)
+                if klass is None:
+                    continue
+                obj = klass(path)
+            obj._cache = dict([(interface, dict(props)) for interface, props in interfaces.items()])
+            ret[six.text_type(path)] = obj
+        return ret
+
 class Statistics(NMDbusInterface):
     object_path = '/org/freedesktop/NetworkManager/Statistics'
 
@@ -301,7 +1684,14 @@ class Connection(NMDbusInterface):
 
     def __init__(self, object_path):
         super(Connection, self).__init__(object_path)
-        self.uuid = self.GetSettings()['connection']['uuid']
+        self._uuid = None
+
+    # Fetching the settings is expensive, so only do it when the uuid is needed
+    @property
+    def uuid(self):
+        if self._uuid is None:
+            self._uuid = self.GetSettings()['connection']['uuid']
+        return self._uuid
 
     def GetSecrets(self, name=None):
         settings = self.GetSettings()
@@ -320,15 +1710,125 @@ class Connection(NMDbusInterface):
         return Settings.ListConnections()
 
     def __eq__(self, other):
-        return isinstance(other, type(self)) and self.uuid == other.uuid
+        return isinstance(other, type(self)) and (self is other or self.uuid == other.uuid)
+
+class SettingsMirror(object):
+    """A local copy of the settings of all connections, indexed by uuid, id,
+       interface name and type. If there is a mainloop, the copy is kept up to
+       date using the NewConnection, ConnectionRemoved and Updated signals."""
+    def __init__(self):
+        self.connections = {}
+        self.settings = {}
+        self.by_uuid = {}
+        self.by_id = {}
+        self.by_interface = {}
+        self.by_type = {}
+        self.handlers = {}
+        self.settings_handlers = []
+        self.listening = bool(dbus.get_default_main_loop())
+        if self.listening:
+            self.settings_handlers = [
+                Settings.OnNewConnection(self._new_connection),
+                Settings.OnConnectionRemoved(self._connection_removed),
+            ]
+            SignalDispatcher.add_restart_handler(self._restarted)
+        self.reload()
+
+    def close(self):
+        """Stop keeping the copy up to date, and remove all signal handlers"""
+        SignalDispatcher.remove_restart_handler(self._restarted)
+        for handler in self.settings_handlers:
+            handler.remove()
+        self.settings_handlers = []
+        for path in list(self.handlers):
+            self._forget(path)
+        self.listening = False
+
+    def reload(self):
+        for path in list(self.connections):
+            self.remove(path)
+            self._forget(path)
+        for connection in Settings.ListConnections():
+            self.add(connection)
+
+    def add(self, connection):
+        try:
+            settings = connection.GetSettings()
+        except ObjectVanished:
+            return
+        path = connection.object_path
+        if path in self.connections:
+            self.remove(path)
+        if self.listening and path not in self.handlers:
+            self.handlers[path] = connection.OnUpdated(self._updated)
+        connection._uuid = settings['connection']['uuid']
+        self.connections[path] = connection
+        self.settings[path] = settings
+        self.by_uuid[connection._uuid] = connection
+        for index, key in self._indexes():
+            if key in settings['connection']:
+                index.setdefault(settings['connection'][key], []).append(connection)
+
+    def remove(self, path):
+        connection = self.connections.pop(path, None)
+        if connection is None:
+            return
+        settings = self.settings.pop(path)
+        self.by_uuid.pop(settings['connection']['uuid'], None)
+        for index, key in self._indexes():
+            value = settings['connection'].get(key, None)
+            if connection in index.get(value, []):
+                index[value].remove(connection)
+                if not index[value]:
+                    del index[value]
+
+    def _indexes(self):
+        return ((self.by_id, 'id'), (self.by_interface, 'interface-name'), (self.by_type, 'type'))
+
+    def get(self, uuid):
+        return self.by_uuid.get(uuid, None)
+
+    def find(self, id=None, interface=None, type=None):
+        """Find connections by id, interface name and/or type"""
+        buckets = [index.get(value, []) for index, value in ((self.by_id, id), (self.by_interface, interface), (self.by_type, type)) if value is not None]
+        if not buckets:
+            return list(self.connections.values())
+        # Start from the smallest bucket and only keep what's in all others
+        buckets.sort(key=len)
+        others = [set([x.object_path for x in bucket]) for bucket in buckets[1:]]
+        return [x for x in buckets[0] if all([x.object_path in paths for paths in others])]
+
+    def _new_connection(self, settings, interface, signal, connection):
+        self.add(connection)
+
+    def _connection_removed(self, settings, interface, signal, connection):
+        self.remove(connection.object_path)
+        self._forget(connection.object_path)
+
+    def _forget(self, path):
+        handler = self.handlers.pop(path, None)
+        if handler is not None:
+            handler.remove()
+
+    def _restarted(self, state, info):
+        # Connections may have been changed while NetworkManager was away
+        if state == 'ready':
+            self.reload()
+
+    def _updated(self, connection, interface, signal):
+        if connection.object_path in self.connections:
+            self.add(connection)
 
 class ActiveConnection(TransientNMDbusInterface):
     interface_names = ['org.freedesktop.NetworkManager.Connection.Active']
     def __new__(klass, object_path):
         if klass == ActiveConnection:
             # Automatically turn this into a VPNConnection if needed
-            obj = dbus.SystemBus().get_object(klass.dbus_service, object_path)
-            if obj.Get('org.freedesktop.NetworkManager.Connection.Active', 'Vpn', dbus_interface='org.freedesktop.DBus.Properties'):
+            if object_path not in klass.specializations:
+                obj = dbus.SystemBus().get_object(klass.dbus_service, object_path)
+                vpn = obj.Get('org.freedesktop.NetworkManager.Connection.Active', 'Vpn', dbus_interface='org.freedesktop.DBus.Properties')
+                klass.specializations[six.text_type(object_path)] = VPNConnection if vpn else ActiveConnection
+            if klass.specializations[object_path] is VPNConnection:
                 return VPNConnection.__new__(VPNConnection, object_path)
         return super(ActiveConnection, klass).__new__(klass, object_path)
 
@@ -344,9 +1844,16 @@ class Device(NMDbusInterface):
         if klass == Device:
             # Automatically specialize the device
             try:
-                obj = dbus.SystemBus().get_object(klass.dbus_service, object_path)
-                klass = device_class(obj.Get('org.freedesktop.NetworkManager.Device', 'DeviceType', dbus_interface='org.freedesktop.DBus.Properties'))
-                return klass.__new__(klass, object_path)
+                if object_path not in klass.specializations:
+                    obj = dbus.SystemBus().get_object(klass.dbus_service, object_path)
+                    try:
+                        specialization = device_class(obj.Get('org.freedesktop.NetworkManager.Device', 'DeviceType', dbus_interface='org.freedesktop.DBus.Properties'))
+                    except KeyError:
+                        specialization = Device
+                    klass.specializations[six.text_type(object_path)] = specialization
+                if klass.specializations[object_path] is not Device:
+                    klass = klass.specializations[object_path]
+                    return klass.__new__(klass, object_path)
             except ObjectVanished:
                 pass
         return super(Device, klass).__new__(klass, object_path)
@@ -397,6 +1904,34 @@ def device_class(typ):
         NM_DEVICE_TYPE_WIFI_P2P: WifiP2p,
     }[typ]
 
+def object_class(path, interfaces):
+    """Find the class for an object, based on its path and the properties of
+       its interfaces as returned by GetManagedObjects"""
+    if not path.startswith('/org/freedesktop/NetworkManager/'):
+        return None
+    classname = path.split('/')[4]
+    classname = {
+       'Settings': 'Connection',
+       'Devices': 'Device',
+    }.get(classname, classname)
+    klass = globals().get(classname, None)
+    if not isinstance(klass, type) or not issubclass(klass, NMDbusInterface):
+        return None
+    # Remember what we found, so creating these objects later on doesn't need
+    # any D-Bus calls to find out their type.
+    if klass is Device and 'org.freedesktop.NetworkManager.Device' in interfaces:
+        try:
+            klass = device_class(interfaces['org.freedesktop.NetworkManager.Device']['DeviceType'])
+        except KeyError:
+            # A device type we don't know about yet
+            klass = Device
+        NMDbusInterface.specializations[six.text_type(path)] = klass
+    if klass is ActiveConnection and 'org.freedesktop.NetworkManager.Connection.Active' in interfaces:
+        if interfaces['org.freedesktop.NetworkManager.Connection.Active']['Vpn']:
+            klass = VPNConnection
+        NMDbusInterface.specializations[six.text_type(path)] = klass
+    return klass
+
 class Adsl(Device): pass
 class Bluetooth(Device): pass
 class Bond(Device): pass
@@ -414,7 +1949,37 @@ class Vlan(Device): pass
 class Vxlan(Device): pass
 class Wimax(Device): pass
 class Wired(Device): pass
-class Wireless(Device): pass
+class Wireless(Device):
+    def scan_table(self, columns=None):
+        """Fetch the properties of all access points this device sees, without
+           creating AccessPoint objects, and return them as an
+           AccessPointTable. columns is a list of properties to include, by
+           default the ones in AccessPointTable.default_columns."""
+        interface = 'org.freedesktop.NetworkManager.AccessPoint'
+        proxy = dbus.SystemBus().get_object(self.dbus_service, '/org/freedesktop')
+        try:
+            data = proxy.GetManagedObjects(dbus_interface='org.freedesktop.DBus.ObjectManager', byte_arrays=True)
+            paths = [path for path in data[self.object_path]['org.freedesktop.NetworkManager.Device.Wireless']['AccessPoints'] if path in data]
+            props = [data[path][interface] for path in paths]
+        except dbus.exceptions.DBusException as e:
+            # Older NetworkManager versions don't have an ObjectManager
+            if e.get_dbus_name() != 'org.freedesktop.DBus.Error.UnknownMethod':
+                raise
+            paths = self.proxy.Get('org.freedesktop.NetworkManager.Device.Wireless', 'AccessPoints', dbus_interface='org.freedesktop.DBus.Properties')
+            props = []
+            for path in paths:
+                try:
+                    props.append(dbus.SystemBus().get_object(self.dbus_service, path).GetAll(interface, dbus_interface='org.freedesktop.DBus.Properties', byte_arrays=True))
+                except dbus.exceptions.DBusException:
+                    # Access points come and go while we're fetching them
+                    paths = [x for x in paths if x != path]
+        except KeyError:
+            raise ObjectVanished(self)
+        if paths and not AccessPoint.introspection_data:
+            # We need the signatures of the properties
+            AccessPoint(paths[0])
+        return AccessPointTable(paths, props, columns)
+
 class MacSec(Device): pass
 class Dummy(Device): pass
 class PPP(Device): pass
@@ -440,6 +2005,602 @@ class AccessPoint(NMDbusInterface):
     def __eq__(self, other):
         return isinstance(other, type(self)) and self.HwAddress == other.HwAddress
 
+class AccessPointTable(object):
+    """Properties of a list of access points, stored per column. Numeric
+       columns are stored in arrays. Iterating over the table or indexing it
+       gives AccessPointRecord objects, which give access to the values of a
+       single access point as attributes."""
+    default_columns = ('Ssid', 'HwAddress', 'Frequency', 'Strength', 'Flags', 'WpaFlags', 'RsnFlags', 'LastSeen')
+    # 'L' and 'l' take 8 bytes on 64-bit Linux, 'I' and 'i' are 4 bytes
+    typecodes = {'y': 'B', 'q': 'H', 'n': 'h', 'u': 'I', 'i': 'i'}
+
+    def __init__(self, paths, props, columns=None):
+        self.columns = tuple(columns or self.default_columns)
+        self.paths = [six.text_type(path) for path in paths]
+        signatures = dict([(attrib['name'], attrib['type']) for attrib in
+            ((AccessPoint.introspection_data or {}).get('org.freedesktop.NetworkManager.AccessPoint') or {}).get('properties', [])])
+        self.data = {}
+        for column in self.columns:
+            signature = signatures.get(column, None)
+            convert = fixups.converter('to_python', 'AccessPoint', 'Get', column, signature)
+            values = [convert(ap[column]) if column in ap else None for ap in props]
+            if signature in self.typecodes and None not in values:
+                values = array.array(self.typecodes[signature], values)
+            self.data[column] = values
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [AccessPointRecord(self, i) for i in range(*index.indices(len(self.paths)))]
+        if index < 0:
+            index += len(self.paths)
+        if not 0 <= index < len(self.paths):
+            raise IndexError(index)
+        return AccessPointRecord(self, index)
+
+    def __iter__(self):
+        for index in range(len(self.paths)):
+            yield AccessPointRecord(self, index)
+
+    def column(self, name):
+        return self.data[name]
+
+class AccessPointRecord(object):
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getattr__(self, name):
+        if name not in self.table.data:
+            raise AttributeError(name)
+        return self.table.data[name][self.index]
+
+    @property
+    def object_path(self):
+        return self.table.paths[self.index]
+
+    def access_point(self):
+        return fixups.path_to_python(dbus.ObjectPath(self.object_path))
+
+    def __repr__(self):
+        return '<AccessPointRecord %s>' % ', '.join(['%s=%r' % (column, getattr(self, column)) for column in self.table.columns])
+
+AccessPointEvent = collections.namedtuple('AccessPointEvent', ('event', 'device', 'object_path', 'values', 'changed'))
+
+class AccessPointMonitor(object):
+    """Keeps track of the access points seen by all wireless devices and
+       reports them being added, removed or changed as AccessPointEvent
+       tuples. values holds the last known values of the properties in
+       columns, also for removed access points, and changed maps the names of
+       changed properties to their old and new values. Events are passed to
+       callback, or queued for pending() if there is no callback. This needs a
+       mainloop."""
+    def __init__(self, callback=None, columns=None):
+        if not dbus.get_default_main_loop():
+            raise RuntimeError("Monitoring access points requires a mainloop")
+        self.callback = callback
+        self.columns = tuple(columns or AccessPointTable.default_columns)
+        self.queue = collections.deque()
+        self.devices = {}
+        self.device_handlers = {}
+        self.access_points = {}
+        self.locations = {}
+        self.handlers = [
+            NetworkManager.OnDeviceAdded(self._device_added),
+            NetworkManager.OnDeviceRemoved(self._device_removed),
+        ]
+        # One match for the property changes of all access points, instead
+        # of one per access point. Others are filtered out when they arrive.
+        SignalDispatcher.add_match(self._properties_changed, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', None,
+            'org.freedesktop.NetworkManager.AccessPoint')
+        SignalDispatcher.add_restart_handler(self._restarted)
+        self.sync()
+
+    def close(self):
+        """Stop monitoring. No more events are emitted, and all signal
+           handlers are removed."""
+        SignalDispatcher.remove_restart_handler(self._restarted)
+        SignalDispatcher.remove_match(self._properties_changed, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', None,
+            'org.freedesktop.NetworkManager.AccessPoint')
+        for handler in self.handlers:
+            handler.remove()
+        self.handlers = []
+        for path in list(self.devices):
+            self.devices.pop(path)
+            for handler in self.device_handlers.pop(path, []):
+                handler.remove()
+        self.access_points.clear()
+        self.locations.clear()
+
+    def sync(self):
+        """Bring the list of access points up to date, and emit events for
+           everything that changed since the last sync"""
+        devices = dict([(device.object_path, device) for device in NetworkManager.Devices if isinstance(device, Wireless)])
+        for path in list(self.devices):
+            if path not in devices:
+                self._remove_device(path)
+        seen = set()
+        for device in devices.values():
+            self._add_device(device)
+            seen.update(self._scan(device))
+        for path in list(self.access_points):
+            if path not in seen:
+                self._remove(path)
+
+    def pending(self):
+        """Yield the events that were queued since the last call"""
+        while self.queue:
+            yield self.queue.popleft()
+
+    def _emit(self, event, device, path, values, changed=None):
+        event = AccessPointEvent(event, device, path, dict(values), changed or {})
+        if self.callback:
+            self.callback(event)
+        else:
+            self.queue.append(event)
+
+    def _scan(self, device):
+        try:
+            table = device.scan_table(self.columns)
+        except ObjectVanished:
+            return []
+        for record in table:
+            self._update(device, record.object_path, dict([(column, getattr(record, column)) for column in self.columns]))
+        return table.paths
+
+    def _add_device(self, device):
+        if device.object_path in self.devices:
+            return
+        self.devices[device.object_path] = device
+        self.device_handlers[device.object_path] = [
+            device.OnAccessPointAdded(self._access_point_added),
+            device.OnAccessPointRemoved(self._access_point_removed),
+        ]
+
+    def _remove_device(self, path):
+        # Access points are removed first, so their events still have the device
+        for ap_path, device_path in list(self.locations.items()):
+            if device_path == path:
+                self._remove(ap_path)
+        self.devices.pop(path, None)
+        for handler in self.device_handlers.pop(path, []):
+            handler.remove()
+
+    def _update(self, device, path, values):
+        if path not in self.access_points:
+            self.access_points[path] = values
+            self.locations[path] = device.object_path
+            self._emit('added', device, path, values)
+            return
+        old = self.access_points[path]
+        changed = dict([(key, (old.get(key, None), value)) for key, value in values.items() if old.get(key, None) != value])
+        if changed:
+            old.update(values)
+            self._emit('changed', device, path, old, changed)
+
+    def _remove(self, path):
+        values = self.access_points.pop(path, None)
+        if values is None:
+            return
+        device = self.devices.get(self.locations.pop(path), None)
+        self._emit('removed', device, path, values)
+
+    def _device_added(self, nm, interface, signal, device_path):
+        if isinstance(device_path, Wireless):
+            self._add_device(device_path)
+            self._scan(device_path)
+
+    def _device_removed(self, nm, interface, signal, device_path):
+        if device_path is not None:
+            self._remove_device(device_path.object_path)
+
+    def _access_point_added(self, device, interface, signal, access_point):
+        try:
+            values = access_point.get_all()
+        except ObjectVanished:
+            return
+        self._update(device, access_point.object_path, dict([(column, values.get(column, None)) for column in self.columns]))
+
+    def _access_point_removed(self, device, interface, signal, access_point):
+        self._remove(access_point.object_path)
+
+    def _properties_changed(self, interface_name, changed, invalidated, **kwargs):
+        path = six.text_type(kwargs['path'])
+        if interface_name != 'org.freedesktop.NetworkManager.AccessPoint' or path not in self.access_points:
+            return
+        values = {}
+        for name, value in changed.items():
+            if name in self.columns:
+                values[name] = fixups.converter('to_python', 'AccessPoint', 'Get', name, None)(value)
+        if values:
+            self._update(self.devices.get(self.locations[path], None), path, values)
+
+    def _restarted(self, state, info):
+        # Access points and devices may have new paths
+        if state == 'ready':
+            self.sync()
+
+class StrengthHistory(object):
+    """Strength samples of a single BSSID, stored in preallocated arrays"""
+    __slots__ = ('ssid', 'smoothed', 'last_seen', 'visible', 'times', 'strengths', 'pos', 'count')
+
+    def __init__(self, ssid, size):
+        self.ssid = ssid
+        self.smoothed = None
+        self.last_seen = 0
+        self.visible = True
+        self.times = array.array('d', [0]) * size
+        self.strengths = array.array('B', [0]) * size
+        self.pos = self.count = 0
+
+    def add(self, when, strength, alpha):
+        self.times[self.pos] = when
+        self.strengths[self.pos] = strength
+        self.pos = (self.pos + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+        self.last_seen = when
+        if self.smoothed is None:
+            self.smoothed = float(strength)
+        else:
+            self.smoothed = alpha * strength + (1 - alpha) * self.smoothed
+
+    def samples(self):
+        indexes = [(self.pos - self.count + i) % len(self.times) for i in range(self.count)]
+        return [(self.times[i], self.strengths[i]) for i in indexes]
+
+class StrengthTracker(object):
+    """Tracks the signal strength of all BSSIDs seen by wireless devices,
+       smoothed with an exponentially weighted moving average, and keeps
+       track of the strongest BSSID for each SSID. BSSIDs that have not been
+       seen for max_age seconds are forgotten. This needs a mainloop."""
+    def __init__(self, alpha=0.3, size=60, max_age=300):
+        self.alpha = alpha
+        self.size = size
+        self.max_age = max_age
+        # (device path, bssid) -> StrengthHistory
+        self.histories = {}
+        # (device path, ssid) -> set of bssids / strongest visible bssid
+        self.members = {}
+        self.strongest = {}
+        # access point path -> (device path, bssid)
+        self.paths = {}
+        self.last_expiry = time.time()
+        self.monitor = AccessPointMonitor(self._event, ('Ssid', 'HwAddress', 'Strength'))
+
+    def close(self):
+        """Stop tracking and remove all signal handlers. What has been
+           tracked so far can still be queried."""
+        self.monitor.close()
+
+    def best(self, device, ssid):
+        """The BSSID with the highest smoothed strength for ssid on device"""
+        return self.strongest.get((device.object_path, ssid), None)
+
+    def strength(self, device, bssid):
+        """The smoothed strength of bssid on device"""
+        history = self.histories.get((device.object_path, bssid), None)
+        return history and history.smoothed
+
+    def history(self, device, bssid):
+        """The strength samples of bssid on device, as (time, strength) tuples"""
+        history = self.histories.get((device.object_path, bssid), None)
+        return history.samples() if history else []
+
+    def _event(self, event):
+        now = time.time()
+        if event.event == 'removed':
+            # Removals are keyed on the access point, the device may be gone
+            key = self.paths.pop(event.object_path, None)
+            history = self.histories.get(key, None)
+            if history is not None:
+                history.visible = False
+                history.last_seen = now
+                self._rank(key[0], history.ssid, key[1])
+        elif event.device is None:
+            return
+        elif event.event == 'added' or 'Strength' in event.changed:
+            device = event.device.object_path
+            key = self.paths[event.object_path] = (device, event.values['HwAddress'])
+            history = self.histories.get(key, None)
+            if history is None or history.ssid != event.values['Ssid']:
+                if history is not None:
+                    self._forget(key)
+                history = self.histories[key] = StrengthHistory(event.values['Ssid'], self.size)
+                self.members.setdefault((device, history.ssid), set()).add(key[1])
+            history.visible = True
+            history.add(now, event.values['Strength'], self.alpha)
+            self._rank(device, history.ssid, key[1])
+        if now - self.last_expiry > self.max_age / 10.0:
+            self._expire(now)
+
+    def _rank(self, device, ssid, bssid):
+        # Only a change of the current strongest BSSID needs a full recount
+        current = self.strongest.get((device, ssid), None)
+        history = self.histories[(device, bssid)]
+        if current is not None and current != bssid:
+            if history.visible and history.smoothed > self.histories[(device, current)].smoothed:
+                self.strongest[(device, ssid)] = bssid
+            return
+        visible = [(self.histories[(device, x)].smoothed, x) for x in self.members.get((device, ssid), ()) if self.histories[(device, x)].visible]
+        if visible:
+            self.strongest[(device, ssid)] = max(visible)[1]
+        else:
+            self.strongest.pop((device, ssid), None)
+
+    def _forget(self, key):
+        history = self.histories.pop(key)
+        members = self.members[(key[0], history.ssid)]
+        members.discard(key[1])
+        if not members:
+            del self.members[(key[0], history.ssid)]
+        if self.strongest.get((key[0], history.ssid), None) == key[1]:
+            self.strongest.pop((key[0], history.ssid))
+            if members:
+                self._rank(key[0], history.ssid, next(iter(members)))
+
+    def _expire(self, now):
+        self.last_expiry = now
+        for key, history in list(self.histories.items()):
+            if not history.visible and now - history.last_seen > self.max_age:
+                self._forget(key)
+
+class ScanScheduler(object):
+    """Coalesces scan requests for wireless devices. Requests for a device
+       that is already scanning are served by that scan, and if the last scan
+       finished less than min_interval seconds ago, its results are used
+       instead of scanning again. Scans that take longer than timeout seconds
+       fail. This needs a mainloop."""
+    def __init__(self, min_interval=10, columns=None, timeout=30):
+        if not dbus.get_default_main_loop():
+            raise RuntimeError("Scheduling scans requires a mainloop")
+        from gi.repository import GLib
+        self.GLib = GLib
+        self.min_interval = min_interval
+        self.columns = columns
+        self.timeout = timeout
+        self.devices = {}
+        self.waiting = {}
+        self.timers = {}
+        self.last_scan = {}
+        # Each scan request gets a token, so late replies and timeouts of an
+        # earlier request can't finish a later one.
+        self.tokens = {}
+        self.counter = 0
+        SignalDispatcher.add_restart_handler(self._restarted)
+
+    def scan(self, device, callback, options=None):
+        """Scan for access points on device, and call callback(device, table,
+           error) when the scan is done. table is the AccessPointTable with the
+           scan results. error is None, or the exception that made the scan
+           fail, in which case table holds the results of earlier scans."""
+        path = device.object_path
+        if path in self.waiting:
+            self.waiting[path].append(callback)
+            return
+        if time.time() - self.last_scan.get(path, 0) < self.min_interval:
+            callback(device, *self._table(device, None))
+            return
+        self.devices[path] = device
+        self.waiting[path] = [callback]
+        self.counter += 1
+        token = self.tokens[path] = self.counter
+        self.timers[path] = self.GLib.timeout_add(int(self.timeout * 1000), self._timeout, path, token)
+        # Scans are done when LastScan changes. Older NetworkManager versions
+        # don't have that property, we consider the scan done when
+        # NetworkManager accepted the request.
+        has_last_scan = 'LastScan' in type(device).properties
+        if has_last_scan:
+            SignalDispatcher.add_match(self._properties_changed, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', path)
+        try:
+            dbus.Interface(device.proxy, 'org.freedesktop.NetworkManager.Device.Wireless').RequestScan(dbus.Dictionary(options or {}, signature='sv'),
+                reply_handler=lambda: has_last_scan or self._finish(path, None, token),
+                error_handler=lambda error: self._finish(path, error, token))
+        except ObjectVanished as e:
+            self._finish(path, e, token)
+
+    def close(self):
+        """Stop listening for scan results and restarts. Scans that are
+           still running fail with ObjectVanished."""
+        SignalDispatcher.remove_restart_handler(self._restarted)
+        for path in list(self.waiting):
+            self._finish(path, ObjectVanished(self.devices[path]))
+
+    def _table(self, device, error):
+        try:
+            return device.scan_table(self.columns), error
+        except ObjectVanished as e:
+            return AccessPointTable([], [], self.columns), error or e
+
+    def _timeout(self, path, token):
+        if self.tokens.get(path, None) == token:
+            del self.timers[path]
+            self._finish(path, dbus.exceptions.DBusException("Scan did not finish within %s seconds" % self.timeout, name='org.freedesktop.DBus.Error.Timeout'), token)
+        return False
+
+    def _finish(self, path, error, token=None):
+        # Without a token, whatever scan is running for path is finished
+        if path not in self.waiting or token not in (None, self.tokens[path]):
+            return
+        del self.tokens[path]
+        device = self.devices.pop(path)
+        callbacks = self.waiting.pop(path)
+        if path in self.timers:
+            self.GLib.source_remove(self.timers.pop(path))
+        SignalDispatcher.remove_match(self._properties_changed, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', path)
+        table, error = self._table(device, error)
+        if error is None:
+            self.last_scan[path] = time.time()
+        for callback in callbacks:
+            callback(device, table, error)
+
+    def _properties_changed(self, interface_name, changed, invalidated, **kwargs):
+        path = six.text_type(kwargs['path'])
+        if interface_name == 'org.freedesktop.NetworkManager.Device.Wireless' and 'LastScan' in changed and path in self.waiting:
+            self._finish(path, None)
+
+    def _restarted(self, state, info):
+        # Scans that were running when NetworkManager stopped never finish
+        if state == 'ready':
+            self.last_scan.clear()
+            for path in list(self.waiting):
+                self._finish(path, ObjectVanished(self.devices[path]))
+
+class StatisticsRing(object):
+    """Fixed-size buffer of (time, tx bytes, rx bytes) samples, stored in
+       preallocated arrays that are overwritten when the buffer is full"""
+    __slots__ = ('size', 'times', 'tx', 'rx', 'pos', 'count')
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', [0]) * size
+        self.tx = array.array('d', [0]) * size
+        self.rx = array.array('d', [0]) * size
+        self.pos = self.count = 0
+
+    def add(self, when, tx, rx):
+        self.times[self.pos] = when
+        self.tx[self.pos] = tx
+        self.rx[self.pos] = rx
+        self.pos = (self.pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def indexes(self, seconds=None):
+        """Indexes of the samples, oldest first, optionally limited to the
+           last seconds seconds"""
+        ret = [(self.pos - self.count + i) % self.size for i in range(self.count)]
+        if seconds is not None and ret:
+            since = self.times[ret[-1]] - seconds
+            ret = [i for i in ret if self.times[i] >= since]
+        return ret
+
+class StatisticsSampler(object):
+    """Samples the traffic counters of devices every interval seconds, using
+       NetworkManager's Statistics interface, and keeps the last size samples
+       of each device. This needs a mainloop."""
+    def __init__(self, interval=1, size=300):
+        if not dbus.get_default_main_loop():
+            raise RuntimeError("Sampling statistics requires a mainloop")
+        self.interval = interval
+        self.size = size
+        self.devices = {}
+        self.rings = {}
+        self.counters = {}
+        SignalDispatcher.add_restart_handler(self._restarted)
+
+    def add(self, device):
+        """Start sampling device"""
+        path = device.object_path
+        if path in self.devices:
+            return
+        self.devices[path] = device
+        self.rings[path] = StatisticsRing(self.size)
+        self._start(device)
+
+    def remove(self, device):
+        """Stop sampling device and forget its samples"""
+        path = device.object_path
+        if self.devices.pop(path, None) is None:
+            return
+        del self.rings[path]
+        counters = self.counters.pop(path, None)
+        SignalDispatcher.remove_match(self._properties_changed, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', path)
+        if counters is None:
+            return
+        try:
+            # Someone else may have asked for statistics before us
+            device.RefreshRateMs = counters[3]
+        except ObjectVanished:
+            pass
+
+    def close(self):
+        """Stop sampling all devices"""
+        SignalDispatcher.remove_restart_handler(self._restarted)
+        for device in list(self.devices.values()):
+            self.remove(device)
+
+    def _start(self, device):
+        SignalDispatcher.add_match(self._properties_changed, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', device.object_path)
+        refresh_rate = int(device.RefreshRateMs)
+        device.RefreshRateMs = int(self.interval * 1000)
+        # tx bytes, rx bytes, interface name, refresh rate to restore
+        self.counters[device.object_path] = [int(device.TxBytes), int(device.RxBytes), device.Interface, refresh_rate]
+        self.rings[device.object_path].add(time.time(), *self.counters[device.object_path][:2])
+
+    def samples(self, device, seconds=None):
+        """The samples of device, as (time, tx bytes, rx bytes) tuples"""
+        ring = self.rings[device.object_path]
+        return [(ring.times[i], ring.tx[i], ring.rx[i]) for i in ring.indexes(seconds)]
+
+    def rate(self, device, seconds=None):
+        """Average (tx, rx) rate in bytes per second over the last seconds
+           seconds, or over all samples"""
+        ring = self.rings[device.object_path]
+        indexes = ring.indexes(seconds)
+        if len(indexes) < 2:
+            return (0.0, 0.0)
+        first, last = indexes[0], indexes[-1]
+        duration = (ring.times[last] - ring.times[first]) or 1
+        return ((ring.tx[last] - ring.tx[first]) / duration, (ring.rx[last] - ring.rx[first]) / duration)
+
+    def rates(self, device, seconds=None):
+        """The (time, tx rate, rx rate) of each interval between two samples"""
+        ring = self.rings[device.object_path]
+        indexes = ring.indexes(seconds)
+        ret = []
+        for prev, cur in zip(indexes, indexes[1:]):
+            duration = (ring.times[cur] - ring.times[prev]) or 1
+            ret.append((ring.times[cur], (ring.tx[cur] - ring.tx[prev]) / duration, (ring.rx[cur] - ring.rx[prev]) / duration))
+        return ret
+
+    def percentile(self, device, percent, seconds=None):
+        """The percent'th percentile of the (tx, rx) rates"""
+        rates = self.rates(device, seconds)
+        if not rates:
+            return (0.0, 0.0)
+        # Nearest rank: the smallest value with at least percent% of the
+        # values at or below it
+        index = min(len(rates) - 1, max(0, int(math.ceil(percent / 100.0 * len(rates))) - 1))
+        return (sorted([x[1] for x in rates])[index], sorted([x[2] for x in rates])[index])
+
+    def _properties_changed(self, interface_name, changed, invalidated, **kwargs):
+        path = six.text_type(kwargs['path'])
+        if interface_name != 'org.freedesktop.NetworkManager.Device.Statistics' or path not in self.rings:
+            return
+        if 'TxBytes' not in changed and 'RxBytes' not in changed:
+            # Such as the change of RefreshRateMs when we start sampling
+            return
+        counters = self.counters[path]
+        if 'TxBytes' in changed:
+            counters[0] = int(changed['TxBytes'])
+        if 'RxBytes' in changed:
+            counters[1] = int(changed['RxBytes'])
+        self.rings[path].add(time.time(), counters[0], counters[1])
+
+    def _restarted(self, state, info):
+        # The refresh rate is reset and devices may have new paths, so we
+        # find them again by interface name.
+        if state != 'ready':
+            return
+        devices = dict([(device.Interface, device) for device in NetworkManager.Devices])
+        for path, device in list(self.devices.items()):
+            SignalDispatcher.remove_match(self._properties_changed, 'org.freedesktop.DBus.Properties', 'PropertiesChanged', path)
+            del self.devices[path]
+            ring = self.rings.pop(path)
+            name = self.counters.pop(path)[2]
+            if name not in devices:
+                continue
+            device = devices[name]
+            self.devices[device.object_path] = device
+            self.rings[device.object_path] = ring
+            try:
+                self._start(device)
+            except ObjectVanished:
+                self.remove(device)
+
 class IP4Config(TransientNMDbusInterface): pass
 class IP6Config(TransientNMDbusInterface): pass
 class DHCP4Config(TransientNMDbusInterface): pass
@@ -463,7 +2624,7 @@ class SecretAgent(dbus.service.Object):
         dbus.service.Object.__init__(self, dbus.SystemBus(), self.object_path)
         AgentManager.Register(self.identifier)
 
-    @dbus.service.method(dbus_interface=interface_name, in_signature='a{sa{sv}}osasu', out_signature='a{sa{sv}}')
+    @dbus.service.method(dbus_interface=interface_name, in_signature='a{sa{sv}}osasu', out_signature='a{sa{sv}}', byte_arrays=True)
     def GetSecrets(self, connection, connection_path, setting_name, hints, flags):
         settings = fixups.to_python('SecretAgent', 'GetSecrets', 'connection', connection, 'a{sa{sv}}')
         connection = fixups.to_python('SecretAgent', 'GetSecrets', 'connection_path', connection_path, 'o')
@@ -487,284 +2648,12 @@ def const(prefix, val):
             return key.replace(prefix,'').lower()
     raise ValueError("No constant found for %s* with value %d", (prefix, val))
 
-# Several fixer methods to make the data easier to handle in python
-# - SSID sent/returned as bytes (only encoding tried is utf-8)
-# - IP, Mac address and route metric encoding/decoding
-class fixups(object):
-    @staticmethod
-    def to_dbus(klass, method, arg, val, signature):
-        if arg in ('connection' 'properties') and signature == 'a{sa{sv}}':
-            settings = copy.deepcopy(val)
-            for key in settings:
-                if 'mac-address' in settings[key]:
-                    settings[key]['mac-address'] = fixups.mac_to_dbus(settings[key]['mac-address'])
-                if 'cloned-mac-address' in settings[key]:
-                    settings[key]['cloned-mac-address'] = fixups.mac_to_dbus(settings[key]['cloned-mac-address'])
-                if 'bssid' in settings[key]:
-                    settings[key]['bssid'] = fixups.mac_to_dbus(settings[key]['bssid'])
-                for cert in ['ca-cert', 'client-cert', 'phase2-ca-cert', 'phase2-client-cert', 'private-key']:
-                    if cert in settings[key]:
-                        settings[key][cert] = fixups.cert_to_dbus(settings[key][cert])
-            if 'ssid' in settings.get('802-11-wireless', {}):
-                settings['802-11-wireless']['ssid'] = fixups.ssid_to_dbus(settings['802-11-wireless']['ssid'])
-            if 'ipv4' in settings:
-                if 'address-data' in settings['ipv4']:
-                    for item in settings['ipv4']['address-data']:
-                        item['prefix'] = dbus.UInt32(item['prefix'])
-                    settings['ipv4']['address-data'] = dbus.Array(
-                        settings['ipv4']['address-data'],
-                        signature=dbus.Signature('a{sv}'))
-                if 'route-data' in settings['ipv4']:
-                    for item in settings['ipv4']['route-data']:
-                        item['prefix'] = dbus.UInt32(item['prefix'])
-                    settings['ipv4']['route-data'] = dbus.Array(
-                        settings['ipv4']['route-data'],
-                        signature=dbus.Signature('a{sv}'))
-                if 'addresses' in settings['ipv4']:
-                    settings['ipv4']['addresses'] = [fixups.addrconf_to_dbus(addr,socket.AF_INET) for addr in settings['ipv4']['addresses']]
-                if 'routes' in settings['ipv4']:
-                    settings['ipv4']['routes'] = [fixups.route_to_dbus(route,socket.AF_INET) for route in settings['ipv4']['routes']]
-                if 'dns' in settings['ipv4']:
-                    settings['ipv4']['dns'] = [fixups.addr_to_dbus(addr,socket.AF_INET) for addr in settings['ipv4']['dns']]
-            if 'ipv6' in settings:
-                if 'address-data' in settings['ipv6']:
-                    for item in settings['ipv6']['address-data']:
-                        item['prefix'] = dbus.UInt32(item['prefix'])
-                    settings['ipv6']['address-data'] = dbus.Array(
-                        settings['ipv6']['address-data'],
-                        signature=dbus.Signature('a{sv}'))
-                if 'route-data' in settings['ipv6']:
-                    for item in settings['ipv6']['route-data']:
-                        item['prefix'] = dbus.UInt32(item['prefix'])
-                    settings['ipv6']['route-data'] = dbus.Array(
-                        settings['ipv6']['route-data'],
-                        signature=dbus.Signature('a{sv}'))
-                if 'addresses' in settings['ipv6']:
-                    settings['ipv6']['addresses'] = [fixups.addrconf_to_dbus(addr,socket.AF_INET6) for addr in settings['ipv6']['addresses']]
-                if 'routes' in settings['ipv6']:
-                    settings['ipv6']['routes'] = [fixups.route_to_dbus(route,socket.AF_INET6) for route in settings['ipv6']['routes']]
-                if 'dns' in settings['ipv6']:
-                    settings['ipv6']['dns'] = [fixups.addr_to_dbus(addr,socket.AF_INET6) for addr in settings['ipv6']['dns']]
-            # Get rid of empty arrays/dicts. dbus barfs on them (can't guess
-            # signatures), and if they were to get through, NetworkManager
-            # ignores them anyway.
-            for key in list(settings.keys()):
-                if isinstance(settings[key], dict):
-                    for key2 in list(settings[key].keys()):
-                        if settings[key][key2] in ({}, []):
-                            del settings[key][key2]
-                if settings[key] in ({}, []):
-                    del settings[key]
-            val = settings
-        return fixups.base_to_dbus(val)
-
-    @staticmethod
-    def base_to_dbus(val):
-        if isinstance(val, NMDbusInterface):
-            return val.object_path
-        if hasattr(val.__class__, 'mro'):
-            for klass in val.__class__.mro():
-                if klass.__module__ in ('dbus', '_dbus_bindings'):
-                    return val
-        if hasattr(val, '__iter__') and not isinstance(val, six.string_types):
-            if hasattr(val, 'items'):
-                return dict([(x, fixups.base_to_dbus(y)) for x, y in val.items()])
-            else:
-                return [fixups.base_to_dbus(x) for x in val]
-        return val
-
-    @staticmethod
-    def to_python(klass, method, arg, val, signature):
-        val = fixups.base_to_python(val)
-        klass_af = {'IP4Config': socket.AF_INET, 'IP6Config': socket.AF_INET6}.get(klass, socket.AF_INET)
-        if method == 'Get':
-            if arg == 'Ip4Address':
-                return fixups.addr_to_python(val, socket.AF_INET)
-            if arg == 'Ip6Address':
-                return fixups.addr_to_python(val, socket.AF_INET6)
-            if arg == 'Ssid':
-                return fixups.ssid_to_python(val)
-            if arg == 'Strength':
-                return fixups.strength_to_python(val)
-            if arg == 'Addresses':
-                return [fixups.addrconf_to_python(addr, klass_af) for addr in val]
-            if arg == 'Routes':
-                return [fixups.route_to_python(route, klass_af) for route in val]
-            if arg in ('Nameservers', 'WinsServers'):
-                return [fixups.addr_to_python(addr, klass_af) for addr in val]
-            if arg == 'Options':
-                for key in val:
-                    if key.startswith('requested_'):
-                        val[key] = bool(int(val[key]))
-                    elif val[key].isdigit():
-                        val[key] = int(val[key])
-                    elif key in ('domain_name_servers', 'ntp_servers', 'routers'):
-                        val[key] = val[key].split()
-
-            return val
-        if method == 'GetSettings':
-            if 'ssid' in val.get('802-11-wireless', {}):
-                val['802-11-wireless']['ssid'] = fixups.ssid_to_python(val['802-11-wireless']['ssid'])
-            for key in val:
-                val_ = val[key]
-                if 'mac-address' in val_:
-                    val_['mac-address'] = fixups.mac_to_python(val_['mac-address'])
-                if 'cloned-mac-address' in val_:
-                    val_['cloned-mac-address'] = fixups.mac_to_python(val_['cloned-mac-address'])
-                if 'bssid' in val_:
-                    val_['bssid'] = fixups.mac_to_python(val_['bssid'])
-            if 'ipv4' in val:
-                val['ipv4']['addresses'] = [fixups.addrconf_to_python(addr,socket.AF_INET) for addr in val['ipv4']['addresses']]
-                val['ipv4']['routes'] = [fixups.route_to_python(route,socket.AF_INET) for route in val['ipv4']['routes']]
-                val['ipv4']['dns'] = [fixups.addr_to_python(addr,socket.AF_INET) for addr in val['ipv4']['dns']]
-            if 'ipv6' in val:
-                val['ipv6']['addresses'] = [fixups.addrconf_to_python(addr,socket.AF_INET6) for addr in val['ipv6']['addresses']]
-                val['ipv6']['routes'] = [fixups.route_to_python(route,socket.AF_INET6) for route in val['ipv6']['routes']]
-                val['ipv6']['dns'] = [fixups.addr_to_python(addr,socket.AF_INET6) for addr in val['ipv6']['dns']]
-            return val
-        if method == 'PropertiesChanged':
-            for prop in val:
-                val[prop] = fixups.to_python(klass, 'Get', prop, val[prop], None)
-        return val
-
-    @staticmethod
-    def base_to_python(val):
-        if isinstance(val, dbus.ByteArray):
-            return "".join([str(x) for x in val])
-        if isinstance(val, (dbus.Array, list, tuple)):
-            return [fixups.base_to_python(x) for x in val]
-        if isinstance(val, (dbus.Dictionary, dict)):
-            return dict([(fixups.base_to_python(x), fixups.base_to_python(y)) for x,y in val.items()])
-        if isinstance(val, dbus.ObjectPath):
-            for obj in (NetworkManager, Settings, AgentManager):
-                if val == obj.object_path:
-                    return obj
-            if val.startswith('/org/freedesktop/NetworkManager/'):
-                classname = val.split('/')[4]
-                classname = {
-                   'Settings': 'Connection',
-                   'Devices': 'Device',
-                }.get(classname, classname)
-                return globals()[classname](val)
-            if val == '/':
-                return None
-        if isinstance(val, (dbus.Signature, dbus.String)):
-            return six.text_type(val)
-        if isinstance(val, dbus.Boolean):
-            return bool(val)
-        if isinstance(val, (dbus.Int16, dbus.UInt16, dbus.Int32, dbus.UInt32, dbus.Int64, dbus.UInt64)):
-            return int(val)
-        if isinstance(val, dbus.Byte):
-            return six.int2byte(int(val))
-        return val
-
-    @staticmethod
-    def ssid_to_python(ssid):
-        try:
-            return bytes().join(ssid).decode('utf-8')
-        except UnicodeDecodeError:
-            ssid = bytes().join(ssid).decode('utf-8', 'replace')
-            warnings.warn("Unable to decode ssid %s properly" % ssid, UnicodeWarning)
-            return ssid
-
-    @staticmethod
-    def ssid_to_dbus(ssid):
-        if isinstance(ssid, six.text_type):
-            ssid = ssid.encode('utf-8')
-        return [dbus.Byte(x) for x in ssid]
-
-    @staticmethod
-    def strength_to_python(strength):
-        return struct.unpack('B', strength)[0]
-
-    @staticmethod
-    def mac_to_python(mac):
-        return "%02X:%02X:%02X:%02X:%02X:%02X" % tuple([ord(x) for x in mac])
-
-    @staticmethod
-    def mac_to_dbus(mac):
-        return [dbus.Byte(int(x, 16)) for x in mac.split(':')]
-
-    @staticmethod
-    def addrconf_to_python(addrconf,family):
-        addr, netmask, gateway = addrconf
-        return [
-            fixups.addr_to_python(addr,family),
-            netmask,
-            fixups.addr_to_python(gateway,family)
-        ]
-
-    @staticmethod
-    def addrconf_to_dbus(addrconf,family):
-        addr, netmask, gateway = addrconf
-        if (family == socket.AF_INET):
-            return [
-                fixups.addr_to_dbus(addr,family),
-                fixups.mask_to_dbus(netmask),
-                fixups.addr_to_dbus(gateway,family)
-            ]
-        else:
-            return dbus.Struct(
-                (
-                    fixups.addr_to_dbus(addr,family),
-                    fixups.mask_to_dbus(netmask),
-                    fixups.addr_to_dbus(gateway,family)
-                ), signature = 'ayuay'
-            )
-
-    @staticmethod
-    def addr_to_python(addr,family):
-        if (family == socket.AF_INET):
-            return socket.inet_ntop(family,struct.pack('I', addr))
-        else:
-            return socket.inet_ntop(family,b''.join(addr))
-
-    @staticmethod
-    def addr_to_dbus(addr,family):
-        if (family == socket.AF_INET):
-            return dbus.UInt32(struct.unpack('I', socket.inet_pton(family,addr))[0])
-        else:
-            return dbus.ByteArray(socket.inet_pton(family,addr))
-
-    @staticmethod
-    def mask_to_dbus(mask):
-        return dbus.UInt32(mask)
-
-    @staticmethod
-    def route_to_python(route,family):
-        addr, netmask, gateway, metric = route
-        return [
-            fixups.addr_to_python(addr,family),
-            netmask,
-            fixups.addr_to_python(gateway,family),
-            metric
-        ]
-
-    @staticmethod
-    def route_to_dbus(route,family):
-        addr, netmask, gateway, metric = route
-        return [
-            fixups.addr_to_dbus(addr,family),
-            fixups.mask_to_dbus(netmask),
-            fixups.addr_to_dbus(gateway,family),
-            metric
-        ]
-
-    @staticmethod
-    def cert_to_dbus(cert):
-        if not isinstance(cert, bytes):
-            if not cert.startswith('file://'):
-                cert = 'file://' + cert
-            cert = cert.encode('utf-8') + b'\0'
-        return [dbus.Byte(x) for x in cert]
-
 # Turn NetworkManager and Settings into singleton objects
 NetworkManager = NetworkManager()
 Settings = Settings()
 AgentManager = AgentManager()
 init_bus.close()
 del init_bus
-del xml_cache
 
 # Constants below are generated with makeconstants.py. Do not edit manually.
 NM_CAPABILITY_TEAM = 1
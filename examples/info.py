@@ -28,8 +28,9 @@ print("")
 
 print("Available network devices")
 print("%-10s %-19s %-20s %s" % ("Name", "State", "Driver", "Managed?"))
-for dev in NetworkManager.NetworkManager.GetDevices():
-    print("%-10s %-19s %-20s %s" % (dev.Interface, c('device_state', dev.State), dev.Driver, dev.Managed))
+with NetworkManager.batch():
+    for dev in NetworkManager.NetworkManager.GetDevices():
+        print("%-10s %-19s %-20s %s" % (dev.Interface, c('device_state', dev.State), dev.Driver, dev.Managed))
 
 print("")
 
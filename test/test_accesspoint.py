@@ -22,5 +22,19 @@ class AccessPointTest(TestCase):
                     self.assertIsInstance(ap.Ssid, six.text_type)
                     self.assertIn(ap.Mode, (NetworkManager.NM_802_11_MODE_ADHOC, NetworkManager.NM_802_11_MODE_INFRA, NetworkManager.NM_802_11_MODE_AP))
 
+    def test_scan_table(self):
+        for dev in NetworkManager.NetworkManager.Devices:
+            if isinstance(dev, NetworkManager.Wireless):
+                table = dev.scan_table()
+                self.assertEqual(len(table), len(table.column('Ssid')))
+                for record in table:
+                    self.assertIsMacAddress(record.HwAddress)
+                    self.assertLess(record.Strength, 100)
+                    self.assertIsInstance(record.Ssid, six.text_type)
+                    self.assertEqual(record.access_point().object_path, record.object_path)
+                self.assertEqual([record.object_path for record in table[1:]], table.paths[1:])
+                table = dev.scan_table(['Frequency'])
+                self.assertEqual(table.columns, ('Frequency',))
+
 if __name__ == '__main__':
     unittest.main()
@@ -33,5 +33,56 @@ class DeviceTest(TestCase):
         else:
             self.fail("I don't know how to test %s devices" % type(device).__name__)
 
+    def test_identity(self):
+        devices = NetworkManager.NetworkManager.Devices
+        for dev1, dev2 in zip(devices, NetworkManager.NetworkManager.Devices):
+            self.assertIs(dev1, dev2)
+
+    def test_statistics_ring(self):
+        ring = NetworkManager.StatisticsRing(5)
+        for i in range(6):
+            ring.add(i, i * 100, i * i * 10)
+        self.assertEqual(ring.count, 5)
+        self.assertEqual([ring.times[i] for i in ring.indexes()], [1, 2, 3, 4, 5])
+        self.assertEqual([ring.rx[i] for i in ring.indexes()], [10, 40, 90, 160, 250])
+        self.assertEqual([ring.times[i] for i in ring.indexes(1)], [4, 5])
+
+    def test_statistics(self):
+        try:
+            from dbus.mainloop.glib import DBusGMainLoop
+        except ImportError:
+            self.skipTest("Sampling statistics requires the glib mainloop")
+        DBusGMainLoop(set_as_default=True)
+        sampler = NetworkManager.StatisticsSampler(size=5)
+        device = NetworkManager.NetworkManager.Devices[0]
+        # Feed known samples instead of waiting for real ones
+        ring = sampler.rings[device.object_path] = NetworkManager.StatisticsRing(5)
+        for i in range(6):
+            ring.add(i, i * 100, i * i * 10)
+        self.assertEqual(sampler.rate(device), (100.0, 60.0))
+        self.assertEqual(sampler.rate(device, 1), (100.0, 90.0))
+        self.assertEqual([rate[2] for rate in sampler.rates(device)], [30.0, 50.0, 70.0, 90.0])
+        self.assertEqual(sampler.percentile(device, 0), (100.0, 30.0))
+        self.assertEqual(sampler.percentile(device, 50), (100.0, 50.0))
+        self.assertEqual(sampler.percentile(device, 90), (100.0, 90.0))
+        self.assertEqual(sampler.percentile(device, 100), (100.0, 90.0))
+        sampler.close()
+
+    @unittest.skipUnless(have_permission('network-control'), "don't have permission to change the statistics refresh rate")
+    def test_statistics_refresh_rate(self):
+        try:
+            from dbus.mainloop.glib import DBusGMainLoop
+        except ImportError:
+            self.skipTest("Sampling statistics requires the glib mainloop")
+        DBusGMainLoop(set_as_default=True)
+        device = NetworkManager.NetworkManager.Devices[0]
+        refresh_rate = device.RefreshRateMs
+        sampler = NetworkManager.StatisticsSampler(interval=0.5)
+        sampler.add(device)
+        self.assertEqual(device.RefreshRateMs, 500)
+        sampler.remove(device)
+        self.assertEqual(device.RefreshRateMs, refresh_rate)
+        sampler.close()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+from test import *
+import socket
+
+class FixupsTest(TestCase):
+    def test_settings_bytes(self):
+        settings = {
+            'connection': {'id': 'test', 'type': '802-3-ethernet'},
+            '802-1x': {'password-raw': b'secret', 'phase2-ca-cert': b'file:///tmp/ca.pem\0'},
+            'vpn': {'data': {'key': 'value'}, 'secret': bytearray(b'\x00\x01')},
+        }
+        ret = NetworkManager.fixups.settings_to_dbus(settings)
+        self.assertIsInstance(ret['802-1x']['password-raw'], dbus.ByteArray)
+        self.assertEqual(ret['802-1x']['password-raw'], b'secret')
+        self.assertIsInstance(ret['802-1x']['phase2-ca-cert'], dbus.ByteArray)
+        self.assertIsInstance(ret['vpn']['secret'], dbus.ByteArray)
+        self.assertEqual(ret['vpn']['secret'], b'\x00\x01')
+        self.assertEqual(ret['connection'], settings['connection'])
+
+    def test_settings_dbus_types(self):
+        mac = dbus.ByteArray(b'\x00\x11\x22\x33\x44\x55')
+        addresses = dbus.Array([dbus.Array([dbus.UInt32(16777343), dbus.UInt32(8), dbus.UInt32(0)], signature='u')], signature='au')
+        dns = [dbus.UInt32(16843009), '8.8.8.8']
+        routes = [dbus.Array([dbus.UInt32(10), dbus.UInt32(8), dbus.UInt32(0), dbus.UInt32(0)], signature='u')]
+        ipv6_addresses = [dbus.Struct((dbus.ByteArray(b'\0' * 16), dbus.UInt32(64), dbus.ByteArray(b'\0' * 16)), signature='ayuay')]
+        settings = {
+            '802-3-ethernet': {'mac-address': mac, 'cloned-mac-address': '00:11:22:33:44:55'},
+            'ipv4': {'addresses': addresses, 'dns': dns, 'routes': routes},
+            'ipv6': {'addresses': ipv6_addresses},
+        }
+        ret = NetworkManager.fixups.settings_to_dbus(settings)
+        self.assertIs(ret['802-3-ethernet']['mac-address'], mac)
+        self.assertEqual(ret['802-3-ethernet']['cloned-mac-address'], mac)
+        self.assertIs(ret['ipv4']['addresses'], addresses)
+        self.assertIs(ret['ipv4']['dns'][0], dns[0])
+        self.assertEqual(ret['ipv4']['dns'][1], NetworkManager.fixups.addr_to_dbus('8.8.8.8', socket.AF_INET))
+        self.assertIs(ret['ipv4']['routes'][0], routes[0])
+        self.assertIs(ret['ipv6']['addresses'][0], ipv6_addresses[0])
+        self.assertIs(NetworkManager.fixups.mac_to_dbus(mac), mac)
+
+    def test_split_signature(self):
+        split = NetworkManager.fixups.split_signature
+        self.assertEqual(split('sa{sv}as'), ['s', 'a{sv}', 'as'])
+        self.assertEqual(split('a{sa{sv}}'), ['a{sa{sv}}'])
+        self.assertEqual(split('aauu'), ['aau', 'u'])
+        self.assertEqual(split('a(ayuay)ay'), ['a(ayuay)', 'ay'])
+        self.assertEqual(split('a{sv}'[2:-1]), ['s', 'v'])
+        self.assertEqual(split(''), [])
+
+    def test_signature_to_python(self):
+        convert = NetworkManager.fixups.signature_to_python('a{sa{sv}}')
+        value = dbus.Dictionary({dbus.String('ipv4'): dbus.Dictionary({dbus.String('method'): dbus.String('auto')})})
+        ret = convert(value)
+        self.assertEqual(ret, {'ipv4': {'method': 'auto'}})
+        self.assertIs(type(list(ret.keys())[0]), six.text_type)
+        self.assertIs(type(ret['ipv4']), dict)
+
+        convert = NetworkManager.fixups.signature_to_python('aau')
+        ret = convert(dbus.Array([dbus.Array([dbus.UInt32(1), dbus.UInt32(2)]), dbus.Array([])]))
+        self.assertEqual(ret, [[1, 2], []])
+        self.assertIs(type(ret[0][0]), int)
+
+        convert = NetworkManager.fixups.signature_to_python('a(ayuay)')
+        addr = dbus.ByteArray(b'\xfe\x80' + b'\0' * 14)
+        gateway = dbus.ByteArray(b'\0' * 16)
+        ret = convert(dbus.Array([dbus.Struct((addr, dbus.UInt32(64), gateway))]))
+        self.assertEqual(ret, [[b'\xfe\x80' + b'\0' * 14, 64, b'\0' * 16]])
+        self.assertIs(type(ret[0][0]), bytes)
+
+    def test_make_to_python(self):
+        convert = NetworkManager.fixups.make_to_python('IP6Config', 'Get', 'Addresses', 'a(ayuay)')
+        addr = dbus.ByteArray(b'\xfe\x80' + b'\0' * 14)
+        gateway = dbus.ByteArray(b'\0' * 16)
+        self.assertEqual(convert(dbus.Array([dbus.Struct((addr, dbus.UInt32(64), gateway))])), [['fe80::', 64, '::']])
+        convert = NetworkManager.fixups.make_to_python('AccessPoint', 'Get', 'Strength', 'y')
+        self.assertEqual(convert(dbus.Byte(70)), 70)
+
+    def test_converter_cache(self):
+        convert = NetworkManager.fixups.converter('to_python', 'Connection', 'GetSettings', 'settings', 'a{sa{sv}}')
+        self.assertIs(NetworkManager.fixups.converter('to_python', 'Connection', 'GetSettings', 'settings', 'a{sa{sv}}'), convert)
+        self.assertIsNot(NetworkManager.fixups.converter('to_python', 'Connection', 'GetSecrets', 'secrets', 'a{sa{sv}}'), convert)
+        convert = NetworkManager.fixups.converter('to_dbus', 'Settings', 'AddConnection', 'connection', 'a{sa{sv}}')
+        self.assertIs(convert, NetworkManager.fixups.settings_to_dbus)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+from test import *
+import json
+import shutil
+import tempfile
+
+class IntrospectionCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = type(NetworkManager.IntrospectionCache)()
+        self.cache.directory = self.directory
+        self.cache.version = '1.0'
+        self.cache.interfaces = {'org.freedesktop.NetworkManager.AccessPoint': {'properties': [], 'methods': [], 'signals': []}}
+        self.cache.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def bus(self, xml):
+        class Proxy(object):
+            def Introspect(self, dbus_interface):
+                return xml
+        class Bus(object):
+            def get_object(self, service, path):
+                return Proxy()
+        return Bus()
+
+    def test_vanished_object(self):
+        with open(os.path.join(self.directory, 'introspection.json')) as fd:
+            before = json.load(fd)
+        # The object went away, its introspection data lists no interfaces
+        data = self.cache.introspect(self.bus('<node/>'), '/org/freedesktop/NetworkManager/Devices/99',
+                                     ['org.freedesktop.NetworkManager.Device.Wireless', 'org.freedesktop.NetworkManager.Device'])
+        self.assertEqual(data, {})
+        self.assertNotIn('org.freedesktop.NetworkManager.Device', self.cache.interfaces)
+        with open(os.path.join(self.directory, 'introspection.json')) as fd:
+            self.assertEqual(json.load(fd), before)
+
+    def test_missing_interface(self):
+        xml = '<node><interface name="org.freedesktop.NetworkManager.Device"><property name="State" type="u" access="read"/></interface></node>'
+        data = self.cache.introspect(self.bus(xml), '/org/freedesktop/NetworkManager/Devices/1',
+                                     ['org.freedesktop.NetworkManager.Device', 'org.freedesktop.NetworkManager.Device.Statistics'])
+        self.assertEqual(data['org.freedesktop.NetworkManager.Device']['properties'], [{'name': 'State', 'type': 'u', 'access': 'read'}])
+        self.assertIsNone(data['org.freedesktop.NetworkManager.Device.Statistics'])
+
+if __name__ == '__main__':
+    unittest.main()
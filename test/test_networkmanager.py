@@ -13,6 +13,33 @@ class NetworkManagerTest(TestCase):
             self.assertIsInstance(dev, NetworkManager.Device)
         self.assertIsInstance(NetworkManager.NetworkManager.PrimaryConnection, NetworkManager.ActiveConnection)
 
+    def test_get_all(self):
+        props = NetworkManager.NetworkManager.get_all()
+        self.assertEqual(props['Version'], NetworkManager.NetworkManager.Version)
+        for dev in props['Devices']:
+            self.assertIsInstance(dev, NetworkManager.Device)
+        snapshot = NetworkManager.NetworkManager.snapshot()
+        self.assertEqual(snapshot.Version, props['Version'])
+        self.assertRaises(AttributeError, setattr, snapshot, 'Version', '0.0')
+
+    def test_batch(self):
+        with NetworkManager.batch():
+            version = NetworkManager.NetworkManager.Version
+            for dev in NetworkManager.NetworkManager.Devices:
+                self.assertIsInstance(dev.Interface, six.text_type)
+        self.assertEqual(version, NetworkManager.NetworkManager.Version)
+        with NetworkManager.NetworkManager.batch():
+            self.assertEqual(NetworkManager.NetworkManager.get_all()['State'], NetworkManager.NetworkManager.State)
+
+    def test_snapshot_all(self):
+        objects = NetworkManager.NetworkManager.snapshot_all()
+        for dev in NetworkManager.NetworkManager.Devices:
+            self.assertIn(dev.object_path, objects)
+            self.assertIsInstance(objects[dev.object_path], type(dev))
+            self.assertEqual(objects[dev.object_path].Interface, dev.Interface)
+        for conn in NetworkManager.Settings.Connections:
+            self.assertIsInstance(objects[conn.object_path], NetworkManager.Connection)
+
     @unittest.skipUnless(have_permission('sleep-wake'), "Not allowed to make networkmanager sleep")
     def test_sleep(self):
         NetworkManager.NetworkManager.Sleep(True)
@@ -12,6 +12,25 @@ class SettingsTest(TestCase):
             self.assertIn(conn, conn1)
         conn = NetworkManager.Settings.GetConnectionByUuid(conn1[0].GetSettings()['connection']['uuid'])
 
+    def test_mirror(self):
+        mirror = NetworkManager.SettingsMirror()
+        for conn in NetworkManager.Settings.ListConnections():
+            settings = conn.GetSettings()['connection']
+            self.assertEqual(mirror.get(settings['uuid']), conn)
+            self.assertIn(conn, mirror.find(id=settings['id'], type=settings['type']))
+
+    def test_pipeline(self):
+        connections = NetworkManager.Settings.ListConnections()
+        pipeline = NetworkManager.Pipeline()
+        for conn in connections:
+            pipeline.call(conn, 'GetSettings')
+        pipeline.get(NetworkManager.Settings, 'Hostname')
+        results = pipeline.run()
+        self.assertEqual(len(results), len(connections) + 1)
+        for conn, settings in zip(connections, results):
+            self.assertEqual(settings, conn.GetSettings())
+        self.assertEqual(results[-1], NetworkManager.Settings.Hostname)
+
     @unittest.skipUnless(os.getuid() == 0, "Must be root to reload connections")
     def test_reload(self):
         self.assertTrue(NetworkManager.Settings.ReloadConnections())